@@ -0,0 +1,639 @@
+import json
+import math
+
+from bisect import bisect_right
+from heapq import heappush, heappop
+from queue import SimpleQueue, Empty
+from threading import Thread, Event, Lock
+from typing import Dict, List, Tuple, Union
+
+from database import ConnectionPool
+
+
+class StateBackend:
+    """
+    Storage of computers state: ids, buttons, queues of pending clicks and heartbeats.
+    ComputerHandler keeps Computer objects as a local view and writes changes through backend.
+
+    Click is an entry (seq, button name, count) in the queue of computer, seqs grow for each computer.
+    Entry stays in queue after delivery until agent acknowledges its seq, so lost answers are delivered again
+    """
+
+    # If True, state can be changed by other processes and handler must sync its local view
+    shared = False
+
+    def add_computer(self, user_name: str, adr: str, name: str, last_seen: float, nonce: str) -> int:
+        """
+        :param nonce: Random nonce of computer, agent tokens are bound to it
+        :return: The smallest free computer id (ids start from 1, 0 is broadcast computer)
+        """
+
+        pass
+
+    def remove_computer(self, user_name: str, _id: int):
+        pass
+
+    def restore_ids(self, user_name: str, ids: List[int]):
+        """
+        Mark ids as taken by computers, that were restored from snapshot
+        """
+
+        pass
+
+    def get_computers(self, user_name: str) -> List[dict]:
+        """
+        :return: List of dicts with id, adr, name, last_seen, buttons ({name: text}), tags, broadcast_seq and nonce
+        """
+
+        pass
+
+    def get_last_seen(self, user_name: str, _id: int) -> Union[float, None]:
+        """
+        :return: Time of the last heartbeat or None if computer was removed
+        """
+
+        pass
+
+    def heartbeat(self, user_name: str, _id: int, last_seen: float):
+        pass
+
+    def set_buttons(self, user_name: str, _id: int, buttons: Dict[str, str]):
+        pass
+
+    def set_tags(self, user_name: str, _id: int, tags: List[str]):
+        pass
+
+    def click(self, user_name: str, _id: int, button_name: str, count: int = 1, coalesce: bool = True):
+        """
+        :param coalesce: Add count to not delivered entry of the same button instead of adding new entry
+        """
+
+        pass
+
+    def click_many(self, user_name: str, ids: List[int], button_name: str, count: int = 1, coalesce: bool = True):
+        """
+        Click button of many computers of user at once
+        """
+
+        pass
+
+    def take_clicks(self, user_name: str, _id: int) -> Dict[str, int]:
+        """
+        Atomically take and delete all entries of computer, for agents without acknowledgements
+
+        :return: {button name: clicks count}
+        """
+
+        pass
+
+    def take_pending_clicks(self, user_name: str, _id: int, button_name: str = None) -> Dict[str, int]:
+        """
+        Atomically take and delete not delivered entries of computer. Delivered entries keep their seqs,
+        so agent can acknowledge them
+
+        :param button_name: Take entries of this button only
+        :return: {button name: clicks count}
+        """
+
+        pass
+
+    def deliver_actions(self, user_name: str, _id: int, redeliver: bool = False) -> List[Tuple[int, str, int]]:
+        """
+        Mark entries of computer as delivered
+
+        :param redeliver: Return entries, which were delivered but not acknowledged, too
+        :return: (seq, button name, count) of entries sorted by seq
+        """
+
+        pass
+
+    def ack_actions(self, user_name: str, _id: int, seq: int) -> Dict[str, int]:
+        """
+        Delete entries of computer with seq <= seq
+
+        :return: {button name: clicks count} of deleted entries
+        """
+
+        pass
+
+    def pending(self) -> List[Tuple[str, int]]:
+        """
+        :return: (user name, computer id) of all computers with not delivered clicks
+        """
+
+        pass
+
+    def pending_clicks(self) -> int:
+        """
+        :return: Count of clicks, that were not delivered to computers yet
+        """
+
+        pass
+
+    def add_broadcast(self, user_name: str, action: dict, tags: List[str], created: float) -> int:
+        """
+        Add action to broadcast log of user
+
+        :param tags: Action is applied to computers with any of tags, empty list means all computers
+        :return: Seq of broadcast, seqs grow for all users
+        """
+
+        pass
+
+    def get_broadcasts(self, user_name: str, after: int, until: int) -> List[Tuple[int, List[str], dict]]:
+        """
+        :return: (seq, tags, action) of broadcasts with after < seq <= until
+        """
+
+        pass
+
+    def broadcasts_after(self, seq: int) -> List[Tuple[str, int]]:
+        """
+        :return: (user name, seq) of all broadcasts after seq
+        """
+
+        pass
+
+    def trim_broadcasts(self, user_name: str, before: float):
+        """
+        Delete broadcasts, that were added before the time
+        """
+
+        pass
+
+    def claim_broadcasts(self, user_name: str, _id: int, after: int, seq: int) -> int:
+        """
+        Atomically mark broadcasts up to seq as applied by computer, so each broadcast is applied once
+
+        :param after: Seq applied by local view of computer
+        :return: Seq, that was applied before. Backends, which don't store it, return after
+        """
+
+        pass
+
+
+class MemoryBackend(StateBackend):
+    """
+    In-process backend. Computer objects of the handler are the source of truth,
+    so only ids, queues of clicks and broadcasts are stored here. Queues are lost on restart
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+
+        # user name -> heap of ids, that were freed by remove_computer
+        self.free_ids = {}
+        self.next_ids = {}
+
+        # (user name, id) -> [last seq, entries [seq, button name, count, delivered]]
+        self.actions = {}
+
+        # user name -> list of (seq, created, tags, action)
+        self.broadcasts = {}
+        self.broadcast_seq = 0
+
+    def add_computer(self, user_name: str, adr: str, name: str, last_seen: float, nonce: str) -> int:
+        with self.lock:
+            free_ids = self.free_ids.get(user_name)
+
+            if free_ids:
+                return heappop(free_ids)
+
+            _id = self.next_ids.get(user_name, 1)
+            self.next_ids[user_name] = _id + 1
+
+            return _id
+
+    def remove_computer(self, user_name: str, _id: int):
+        with self.lock:
+            if user_name not in self.free_ids:
+                self.free_ids[user_name] = []
+            heappush(self.free_ids[user_name], _id)
+
+            self.actions.pop((user_name, _id), None)
+
+    def restore_ids(self, user_name: str, ids: List[int]):
+        with self.lock:
+            taken = set(ids)
+            next_id = max(taken, default=0) + 1
+
+            self.next_ids[user_name] = next_id
+            self.free_ids[user_name] = [_id for _id in range(1, next_id) if _id not in taken]
+
+    def get_computers(self, user_name: str) -> List[dict]:
+        return []
+
+    def click(self, user_name: str, _id: int, button_name: str, count: int = 1, coalesce: bool = True):
+        with self.lock:
+            queue = self.actions.setdefault((user_name, _id), [0, []])
+
+            if coalesce:
+                for entry in queue[1]:
+                    if entry[1] == button_name and not entry[3]:
+                        entry[2] += count
+                        return
+
+            queue[0] += 1
+            queue[1].append([queue[0], button_name, count, False])
+
+    def click_many(self, user_name: str, ids: List[int], button_name: str, count: int = 1, coalesce: bool = True):
+        for _id in ids:
+            self.click(user_name, _id, button_name, count, coalesce)
+
+    def take_clicks(self, user_name: str, _id: int) -> Dict[str, int]:
+        ret = {}
+
+        with self.lock:
+            queue = self.actions.get((user_name, _id))
+            if queue is None:
+                return ret
+
+            for _, button_name, count, _ in queue[1]:
+                ret[button_name] = ret.get(button_name, 0) + count
+            queue[1] = []
+
+        return ret
+
+    def take_pending_clicks(self, user_name: str, _id: int, button_name: str = None) -> Dict[str, int]:
+        ret = {}
+
+        with self.lock:
+            queue = self.actions.get((user_name, _id))
+            if queue is None:
+                return ret
+
+            kept = []
+
+            for entry in queue[1]:
+                if entry[3] or (button_name is not None and entry[1] != button_name):
+                    kept.append(entry)
+                else:
+                    ret[entry[1]] = ret.get(entry[1], 0) + entry[2]
+            queue[1] = kept
+
+        return ret
+
+    def deliver_actions(self, user_name: str, _id: int, redeliver: bool = False) -> List[Tuple[int, str, int]]:
+        ret = []
+
+        with self.lock:
+            queue = self.actions.get((user_name, _id))
+            if queue is None:
+                return ret
+
+            for entry in queue[1]:
+                if redeliver or not entry[3]:
+                    entry[3] = True
+                    ret.append((entry[0], entry[1], entry[2]))
+
+        return ret
+
+    def ack_actions(self, user_name: str, _id: int, seq: int) -> Dict[str, int]:
+        ret = {}
+
+        with self.lock:
+            queue = self.actions.get((user_name, _id))
+            if queue is None:
+                return ret
+
+            for entry_seq, button_name, count, _ in queue[1]:
+                if entry_seq <= seq:
+                    ret[button_name] = ret.get(button_name, 0) + count
+            queue[1] = [entry for entry in queue[1] if entry[0] > seq]
+
+        return ret
+
+    def pending(self) -> List[Tuple[str, int]]:
+        with self.lock:
+            return [key for key, queue in self.actions.items() if any(not entry[3] for entry in queue[1])]
+
+    def pending_clicks(self) -> int:
+        with self.lock:
+            return sum(entry[2] for queue in self.actions.values() for entry in queue[1] if not entry[3])
+
+    def add_broadcast(self, user_name: str, action: dict, tags: List[str], created: float) -> int:
+        with self.lock:
+            self.broadcast_seq += 1
+            self.broadcasts.setdefault(user_name, []).append((self.broadcast_seq, created, tags, action))
+
+            return self.broadcast_seq
+
+    def get_broadcasts(self, user_name: str, after: int, until: int) -> List[Tuple[int, List[str], dict]]:
+        with self.lock:
+            broadcasts = self.broadcasts.get(user_name, [])
+            start = bisect_right(broadcasts, (after, math.inf))
+            end = bisect_right(broadcasts, (until, math.inf))
+
+            return [(seq, tags, action) for seq, _, tags, action in broadcasts[start:end]]
+
+    def broadcasts_after(self, seq: int) -> List[Tuple[str, int]]:
+        with self.lock:
+            return [(user_name, broadcasts[-1][0]) for user_name, broadcasts in self.broadcasts.items()
+                    if broadcasts and broadcasts[-1][0] > seq]
+
+    def trim_broadcasts(self, user_name: str, before: float):
+        with self.lock:
+            broadcasts = self.broadcasts.get(user_name, [])
+            count = 0
+
+            # Broadcasts are sorted by seq and by time too
+            while count < len(broadcasts) and broadcasts[count][1] < before:
+                count += 1
+            del broadcasts[:count]
+
+    def claim_broadcasts(self, user_name: str, _id: int, after: int, seq: int) -> int:
+        return after
+
+
+class SQLiteBackend(StateBackend):
+    """
+    Backend in sqlite file, shared by all server processes on one host. Queues of clicks survive restart
+    """
+
+    shared = True
+
+    # Max count of clicks in one transaction
+    max_commit_size = 1000
+
+    def __init__(self, path: str = "state.db", pool_size: int = 16):
+        self.pool = ConnectionPool(path, pool_size)
+        self.connection = self.pool.connection
+
+        self.clicks_queue = SimpleQueue()
+        Thread(target=self.committer, daemon=True).start()
+
+        with self.connection() as db:
+            sql = db.cursor()
+
+            sql.execute("CREATE TABLE IF NOT EXISTS computers (user_name TEXT, id INT, adr TEXT, name TEXT, "
+                        "last_seen REAL, buttons TEXT, tags TEXT DEFAULT '[]', broadcast_seq INT DEFAULT 0, "
+                        "action_seq INT DEFAULT 0, nonce TEXT DEFAULT '', PRIMARY KEY (user_name, id))")
+            sql.execute("CREATE TABLE IF NOT EXISTS actions (user_name TEXT, id INT, seq INT, name TEXT, count INT, "
+                        "delivered INT DEFAULT 0, PRIMARY KEY (user_name, id, seq))")
+            sql.execute("CREATE TABLE IF NOT EXISTS broadcasts (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "user_name TEXT, created REAL, tags TEXT, action TEXT)")
+            sql.execute("CREATE INDEX IF NOT EXISTS broadcasts_user ON broadcasts (user_name, seq)")
+
+            # State files of older versions
+            sql.execute("PRAGMA table_info(computers)")
+            columns = {column[1] for column in sql.fetchall()}
+            if "tags" not in columns:
+                sql.execute("ALTER TABLE computers ADD COLUMN tags TEXT DEFAULT '[]'")
+            if "broadcast_seq" not in columns:
+                sql.execute("ALTER TABLE computers ADD COLUMN broadcast_seq INT DEFAULT 0")
+            if "action_seq" not in columns:
+                sql.execute("ALTER TABLE computers ADD COLUMN action_seq INT DEFAULT 0")
+            if "nonce" not in columns:
+                sql.execute("ALTER TABLE computers ADD COLUMN nonce TEXT DEFAULT ''")
+                sql.execute("UPDATE computers SET nonce=lower(hex(randomblob(8)))")
+            # Clicks without seqs are not moved to actions
+            sql.execute("DROP TABLE IF EXISTS clicks")
+
+    def add_computer(self, user_name: str, adr: str, name: str, last_seen: float, nonce: str) -> int:
+        with self.connection("add_computer") as db:
+            sql = db.cursor()
+
+            # Lock database for writing, so other processes can't take the same id
+            sql.execute("BEGIN IMMEDIATE")
+            sql.execute("SELECT MIN(id) + 1 FROM (SELECT 0 AS id UNION ALL SELECT id FROM computers WHERE user_name=?) "
+                        "WHERE id + 1 NOT IN (SELECT id FROM computers WHERE user_name=?)", (user_name, user_name))
+            _id = sql.fetchone()[0]
+
+            # New computer doesn't get broadcasts, that were sent before
+            sql.execute("INSERT INTO computers (user_name, id, adr, name, last_seen, buttons, nonce, broadcast_seq) "
+                        "VALUES (?, ?, ?, ?, ?, '{}', ?, "
+                        "(SELECT COALESCE(MAX(seq), 0) FROM broadcasts WHERE user_name=?))",
+                        (user_name, _id, adr, name, last_seen, nonce, user_name))
+
+            return _id
+
+    def remove_computer(self, user_name: str, _id: int):
+        with self.connection("remove_computer") as db:
+            sql = db.cursor()
+
+            sql.execute("DELETE FROM computers WHERE user_name=? AND id=?", (user_name, _id))
+            sql.execute("DELETE FROM actions WHERE user_name=? AND id=?", (user_name, _id))
+
+    def get_computers(self, user_name: str) -> List[dict]:
+        with self.connection("get_computers") as db:
+            sql = db.cursor()
+
+            sql.execute("SELECT id, adr, name, last_seen, buttons, tags, broadcast_seq, nonce FROM computers "
+                        "WHERE user_name=?", (user_name,))
+
+            return [{"id": _id, "adr": adr, "name": name, "last_seen": last_seen, "buttons": json.loads(buttons),
+                     "tags": json.loads(tags), "broadcast_seq": broadcast_seq, "nonce": nonce}
+                    for _id, adr, name, last_seen, buttons, tags, broadcast_seq, nonce in sql.fetchall()]
+
+    def get_last_seen(self, user_name: str, _id: int) -> Union[float, None]:
+        with self.connection("get_last_seen") as db:
+            sql = db.cursor()
+
+            sql.execute("SELECT last_seen FROM computers WHERE user_name=? AND id=?", (user_name, _id))
+            computer = sql.fetchone()
+
+            return computer[0] if computer is not None else None
+
+    def heartbeat(self, user_name: str, _id: int, last_seen: float):
+        with self.connection("heartbeat") as db:
+            db.execute("UPDATE computers SET last_seen=MAX(last_seen, ?) WHERE user_name=? AND id=?",
+                       (last_seen, user_name, _id))
+
+    def set_buttons(self, user_name: str, _id: int, buttons: Dict[str, str]):
+        with self.connection("set_buttons") as db:
+            db.execute("UPDATE computers SET buttons=? WHERE user_name=? AND id=?", (json.dumps(buttons), user_name, _id))
+
+    def set_tags(self, user_name: str, _id: int, tags: List[str]):
+        with self.connection("set_tags") as db:
+            db.execute("UPDATE computers SET tags=? WHERE user_name=? AND id=?", (json.dumps(tags), user_name, _id))
+
+    def click(self, user_name: str, _id: int, button_name: str, count: int = 1, coalesce: bool = True):
+        """
+        Clicks of all threads are written by committer thread, many clicks in one transaction (group commit).
+        Returns after the click is committed
+        """
+
+        self.click_many(user_name, [_id], button_name, count, coalesce)
+
+    def click_many(self, user_name: str, ids: List[int], button_name: str, count: int = 1, coalesce: bool = True):
+        """
+        All clicks are queued before waiting, so they are committed together
+        """
+
+        requests = [[(user_name, _id, button_name, count, coalesce), Event(), None] for _id in ids]
+        for request in requests:
+            self.clicks_queue.put(request)
+
+        for request in requests:
+            request[1].wait()
+
+            if request[2] is not None:
+                raise request[2]
+
+    def committer(self):
+        while True:
+            batch = [self.clicks_queue.get()]
+
+            try:
+                while len(batch) < self.max_commit_size:
+                    batch.append(self.clicks_queue.get_nowait())
+            except Empty:
+                pass
+
+            try:
+                with self.connection("click") as db:
+                    sql = db.cursor()
+                    sql.execute("BEGIN IMMEDIATE")
+
+                    for request in batch:
+                        self.add_click(sql, *request[0])
+            except Exception as error:
+                for request in batch:
+                    request[2] = error
+
+            for request in batch:
+                request[1].set()
+
+    @staticmethod
+    def add_click(sql, user_name: str, _id: int, button_name: str, count: int, coalesce: bool):
+        if coalesce:
+            sql.execute("UPDATE actions SET count=count + ? WHERE user_name=? AND id=? AND name=? AND delivered=0",
+                        (count, user_name, _id, button_name))
+            if sql.rowcount:
+                return
+
+        sql.execute("UPDATE computers SET action_seq=action_seq + 1 WHERE user_name=? AND id=? RETURNING action_seq",
+                    (user_name, _id))
+        seq = sql.fetchone()
+
+        # Computer was removed
+        if seq is None:
+            return
+
+        sql.execute("INSERT INTO actions (user_name, id, seq, name, count) VALUES (?, ?, ?, ?, ?)",
+                    (user_name, _id, seq[0], button_name, count))
+
+    def take_clicks(self, user_name: str, _id: int) -> Dict[str, int]:
+        with self.connection("take_clicks") as db:
+            sql = db.cursor()
+
+            # One statement, so concurrent processes can't take the same clicks twice
+            sql.execute("DELETE FROM actions WHERE user_name=? AND id=? RETURNING name, count", (user_name, _id))
+
+            return self.sum_clicks(sql.fetchall())
+
+    def take_pending_clicks(self, user_name: str, _id: int, button_name: str = None) -> Dict[str, int]:
+        with self.connection("take_pending_clicks") as db:
+            sql = db.cursor()
+
+            if button_name is None:
+                sql.execute("DELETE FROM actions WHERE user_name=? AND id=? AND delivered=0 RETURNING name, count",
+                            (user_name, _id))
+            else:
+                sql.execute("DELETE FROM actions WHERE user_name=? AND id=? AND delivered=0 AND name=? "
+                            "RETURNING name, count", (user_name, _id, button_name))
+
+            return self.sum_clicks(sql.fetchall())
+
+    def deliver_actions(self, user_name: str, _id: int, redeliver: bool = False) -> List[Tuple[int, str, int]]:
+        with self.connection("deliver_actions") as db:
+            sql = db.cursor()
+
+            sql.execute("UPDATE actions SET delivered=1 WHERE user_name=? AND id=?" +
+                        ("" if redeliver else " AND delivered=0") + " RETURNING seq, name, count", (user_name, _id))
+
+            return sorted(sql.fetchall())
+
+    def ack_actions(self, user_name: str, _id: int, seq: int) -> Dict[str, int]:
+        with self.connection("ack_actions") as db:
+            sql = db.cursor()
+
+            sql.execute("DELETE FROM actions WHERE user_name=? AND id=? AND seq <= ? RETURNING name, count",
+                        (user_name, _id, seq))
+
+            return self.sum_clicks(sql.fetchall())
+
+    @staticmethod
+    def sum_clicks(rows: List[Tuple[str, int]]) -> Dict[str, int]:
+        ret = {}
+
+        for button_name, count in rows:
+            ret[button_name] = ret.get(button_name, 0) + count
+
+        return ret
+
+    def pending(self) -> List[Tuple[str, int]]:
+        with self.connection("pending") as db:
+            sql = db.cursor()
+
+            sql.execute("SELECT DISTINCT user_name, id FROM actions WHERE delivered=0")
+
+            return sql.fetchall()
+
+    def pending_clicks(self) -> int:
+        with self.connection("pending_clicks") as db:
+            sql = db.cursor()
+
+            sql.execute("SELECT COALESCE(SUM(count), 0) FROM actions WHERE delivered=0")
+
+            return sql.fetchone()[0]
+
+    def add_broadcast(self, user_name: str, action: dict, tags: List[str], created: float) -> int:
+        with self.connection("add_broadcast") as db:
+            sql = db.cursor()
+
+            sql.execute("INSERT INTO broadcasts (user_name, created, tags, action) VALUES (?, ?, ?, ?)",
+                        (user_name, created, json.dumps(tags), json.dumps(action)))
+
+            return sql.lastrowid
+
+    def get_broadcasts(self, user_name: str, after: int, until: int) -> List[Tuple[int, List[str], dict]]:
+        with self.connection("get_broadcasts") as db:
+            sql = db.cursor()
+
+            sql.execute("SELECT seq, tags, action FROM broadcasts WHERE user_name=? AND seq > ? AND seq <= ? "
+                        "ORDER BY seq", (user_name, after, until))
+
+            return [(seq, json.loads(tags), json.loads(action)) for seq, tags, action in sql.fetchall()]
+
+    def broadcasts_after(self, seq: int) -> List[Tuple[str, int]]:
+        with self.connection("broadcasts_after") as db:
+            sql = db.cursor()
+
+            sql.execute("SELECT user_name, MAX(seq) FROM broadcasts WHERE seq > ? GROUP BY user_name", (seq,))
+
+            return sql.fetchall()
+
+    def trim_broadcasts(self, user_name: str, before: float):
+        with self.connection("trim_broadcasts") as db:
+            db.execute("DELETE FROM broadcasts WHERE user_name=? AND created < ?", (user_name, before))
+
+    def claim_broadcasts(self, user_name: str, _id: int, after: int, seq: int) -> int:
+        with self.connection("claim_broadcasts") as db:
+            sql = db.cursor()
+
+            # Other processes may apply broadcasts to the same computer
+            sql.execute("BEGIN IMMEDIATE")
+            sql.execute("SELECT broadcast_seq FROM computers WHERE user_name=? AND id=?", (user_name, _id))
+            computer = sql.fetchone()
+
+            if computer is None or computer[0] >= seq:
+                return seq
+
+            sql.execute("UPDATE computers SET broadcast_seq=? WHERE user_name=? AND id=?", (seq, user_name, _id))
+
+            return computer[0]
+
+
+def create_backend(name: str = "memory", path: str = "state.db") -> StateBackend:
+    """
+    :param name: "memory" (one process) or "sqlite" (many processes on one host)
+    :param path: Path to sqlite file
+    """
+
+    if name == "memory":
+        return MemoryBackend()
+    if name == "sqlite":
+        return SQLiteBackend(path)
+
+    raise ValueError(f"Unknown state backend: {name}")
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache, values expire after ttl seconds
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60):
+        """
+        :param max_size: Max count of cached keys, least recently used keys are evicted first
+        :param ttl: Time to live of value in seconds
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=MISSING):
+        """
+        :return: Cached value (None is a valid value too) or default, if key not cached or expired
+        """
+
+        with self.lock:
+            item = self.data.get(key)
+
+            if item is None or item[1] < monotonic():
+                if item is not None:
+                    del self.data[key]
+
+                self.misses += 1
+                return default
+
+            self.data.move_to_end(key)
+            self.hits += 1
+
+            return item[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, monotonic() + self.ttl)
+            self.data.move_to_end(key)
+
+            if len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self.data), "hits": self.hits, "misses": self.misses}
+
+
+# Caches are shared by all Database objects of the process
+
+# login -> user exists (False is cached too)
+users_cache = TTLCache(100000, 60)
+# login -> password hash from database (None if user not found)
+passwords_cache = TTLCache(100000, 60)
+# login -> hash key (None if not created)
+hash_keys_cache = TTLCache(100000, 60)
@@ -1,11 +1,46 @@
+from backend import StateBackend, MemoryBackend
 from database import Database
+from logger import Logger
+from snapshot import Snapshot
+from tokens import TokenSigner, new_nonce
 
-from threading import Thread
-from time import sleep
-from typing import Union, List, Dict
+import atexit
+import gc
+import os
+import traceback
+
+from fnmatch import fnmatchcase
+from heapq import heappush, heappop, heapify, nsmallest
+from itertools import count
+from queue import SimpleQueue
+from threading import Thread, Event, Lock, RLock, Condition
+from time import sleep, monotonic, time
+from typing import Union, List, Dict, Callable
 
 
 database = Database()
+handler_logger = Logger("ComputerHandler")
+
+MAX_WAIT_TIMEOUT = 15
+# Computer is offline, if it wasn't checked for ONLINE_TIMEOUT seconds
+ONLINE_TIMEOUT = 20
+# Offline computer is disconnected after EVICT_TIMEOUT seconds
+EVICT_TIMEOUT = 600
+# Broadcasts are kept while computers, which didn't apply them, can be connected
+BROADCAST_KEEP_TIME = EVICT_TIMEOUT + ONLINE_TIMEOUT
+# Shared backends only: min interval between heartbeat writes, local view sync and pending clicks checks
+HEARTBEAT_SAVE_INTERVAL = 1
+SYNC_INTERVAL = 1
+PENDING_CHECK_INTERVAL = 0.1
+LOCK_SHARDS_COUNT = 64
+# Memory backend only: interval between snapshots of changed users
+SNAPSHOT_INTERVAL = 10
+# Background threads retry after errors (e.g. locked sqlite database) in ERROR_RETRY_INTERVAL seconds
+ERROR_RETRY_INTERVAL = 1
+
+# Key of request data, set by server if request is authorized by agent token, so hash key is not needed.
+# Object can't be a key of json, so agent can't set it
+TOKEN_AUTHORIZED = object()
 
 
 class ActionType():
@@ -15,26 +50,47 @@ class ActionType():
         self.need_args = need_args
         self.secured = secured
 
+        # Function (computer, data, broadcast) -> answer, set by Action.register
+        self.executor: Union[Callable, None] = None
+
     def has_all_args(self, _dict) -> (bool, list):
+        """
+        :return: Missing args and "name", if it isn't str
+        """
+
         ret = []
 
         for arg in self.need_args:
             if arg not in _dict:
                 ret.append(arg)
 
+        # Names are keys of buttons, other json types can't be used
+        if "name" in _dict and not isinstance(_dict["name"], str) and "name" not in ret:
+            ret.append("name")
+
         return ret
 
-    def gen_error_args(self, _dict):
+    def gen_error_args(self, _dict, user_name: str = None):
+        """
+        :param user_name: Owner of computer, that executes action. Hash key is checked for him, not for
+                          "user_name" of request
+        """
+
         args = self.has_all_args(_dict)
 
         if len(args):
             return Action.gen_action("need_args", "error", args=args)
 
-        if self.secured:
+        if self.secured and not _dict.get(TOKEN_AUTHORIZED):
             if "hash_key" not in _dict:
                 return Action.gen_action("need_hash_key", "error")
 
-            user_hash_key = database.get_hash_key(_dict["user_name"])
+            if user_name is None:
+                user_name = _dict.get("user_name")
+            if not isinstance(user_name, str):
+                return Action.gen_action("need_args", "error", args=["user_name"])
+
+            user_hash_key = database.get_hash_key(user_name)
 
             if user_hash_key is None:
                 return Action.gen_action("hash_key_not_created", "error")
@@ -48,6 +104,32 @@ class ActionType():
 
 class Action:
     action = ""
+    types: Dict[str, ActionType] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        cls.types = {attr.str_type: attr for attr in vars(cls).values() if isinstance(attr, ActionType)}
+
+    @classmethod
+    def register(cls, action_type: Union[ActionType, str], *need_args, secured: bool = False):
+        """
+        Decorator, sets executor of action type. Executor takes (computer, data, broadcast)
+
+        :param action_type: ActionType of this class or str type of new action
+        :param need_args: Required args of new action
+        :param secured: New action requires hash key
+        """
+
+        if not isinstance(action_type, ActionType):
+            action_type = ActionType(action_type, *need_args, secured=secured)
+        cls.types[action_type.str_type] = action_type
+
+        def decorator(executor):
+            action_type.executor = executor
+            return executor
+
+        return decorator
 
     @classmethod
     def gen_action(cls, action_type: Union[ActionType, str], _action: Union[str, None] = None, **kwargs) -> dict:
@@ -66,27 +148,37 @@ class Action:
             return cls.gen_action("need_args", "error", args=args)
 
     @classmethod
-    def parse(cls, data: dict):
-        attrs: Dict[str, ActionType] = cls.__dict__
-        attrs.pop("__module__")
-        attrs.pop("action")
-        attrs.pop("__doc__")
+    def parse(cls, data: dict, user_name: str = None) -> Union[ActionType, dict, None]:
+        """
+        :param user_name: Owner of computer, that executes action
+        :return: ActionType, error action if data is not valid or None if type is unknown
+        """
+
+        str_type = data.get("type")
+
+        # List or object can't be a key of types
+        if str_type is not None and not isinstance(str_type, str):
+            return cls.gen_action("need_args", "error", args=["type"])
 
-        for i in attrs:
-            action_type = attrs[i]
+        action_type = cls.types.get(str_type)
 
-            if action_type == data["type"]:
-                ret = action_type.gen_error_args(data)
-                return ret if ret is not None else action_type
+        if action_type is None:
+            return None
+
+        ret = action_type.gen_error_args(data, user_name)
+        return ret if ret is not None else action_type
 
 
 class Methods(Action):
     action = "method"
 
     COMPUTER_DISCONNECT = ActionType("computer.disconnect")
+    COMPUTER_SET_TAGS = ActionType("computer.set_tags", "tags")
+    COMPUTER_GET_TOKEN = ActionType("computer.get_token", secured=True)
 
-    BUTTON_CLICK = ActionType("button.click")
+    BUTTON_CLICK = ActionType("button.click", "name")
     BUTTON_ADD = ActionType("button.add", "name", "text")
+    BUTTON_ADD_MANY = ActionType("button.add_many", "buttons")
     BUTTON_DELETE = ActionType("button.delete", "name")
     BUTTON_DELETE_ALL = ActionType("button.delete_all")
     BUTTON_RESET_CUR_COUNTER = ActionType("button.reset_cur_counter")
@@ -96,40 +188,70 @@ class Errors(Action):
     action = "error"
 
     NEED_ARGS = ActionType("need_args")
+    UNKNOWN_METHOD = ActionType("unknown_method")
 
     NEED_HASH_KEY = ActionType("need_hash_key")
     WRONG_HASH_KEY = ActionType("wrong_hash_key")
+    # Field can't be overridden by one action of batch
+    SHARED_ARGS = ActionType("shared_args")
     HASH_KEY_NOT_CREATED = ActionType("hash_key_not_created")
 
     USER_NOT_FOUND = ActionType("user_not_found")
+    COMPUTER_NOT_FOUND = ActionType("computer_not_found")
+    # Token is not valid or expired, or its computer was disconnected
+    WRONG_TOKEN = ActionType("wrong_token")
+    BUTTON_NOT_FOUND = ActionType("button_not_found")
+
+    # Have "retry_after" in seconds
+    RATE_LIMITED = ActionType("rate_limited")
+    TOO_MANY_COMPUTERS = ActionType("too_many_computers")
+
+
+class Results(Action):
+    action = "result"
+
+    OK = ActionType("ok")
+    TOKEN = ActionType("token")
+
+
+class Events(Action):
+    action = "event"
+
+    COMPUTER_UPDATE = ActionType("computer.update")
+    COMPUTER_DISCONNECT = ActionType("computer.disconnect")
 
 
 class Button:
+    """
+    Pending clicks are stored in the state backend, button keeps only the count of taken clicks
+    """
+
+    __slots__ = ("name", "text", "all_click_count")
+
     def __init__(self, name, text):
         self.name = name
         self.text = text
 
-        self.click_count = 0
         self.all_click_count = 0
 
-    def click(self):
-        self.click_count += 1
-
-    def reset_cur_counter(self):
-        self.all_click_count += self.click_count
-        self.click_count = 0
+    def gen_action(self, count: int, seq: int = None):
+        if seq is None:
+            self.all_click_count += count
+            return Methods.gen_action(Methods.BUTTON_CLICK, name=self.name, count=count)
 
-    def gen_action(self, reset: bool = False):
-        if reset:
-            self.reset_cur_counter()
-
-        return Methods.gen_action(Methods.BUTTON_CLICK, name=self.name, count=self.click_count)
+        # Clicks with seq are counted, when agent acknowledges them
+        return Methods.gen_action(Methods.BUTTON_CLICK, name=self.name, count=count, seq=seq)
 
 
 class PComputer:
+    __slots__ = ()
+
     def add_button(self, button_name, button_text):
         pass
 
+    def add_buttons(self, buttons: List[dict]):
+        pass
+
     def press_button(self, button_name):
         pass
 
@@ -140,60 +262,290 @@ class PComputer:
         pass
 
 
+# Empty frozenset is not a singleton, so computers without tags share this one
+NO_TAGS = frozenset()
+
+
+def is_tags(tags) -> bool:
+    return isinstance(tags, list) and all(isinstance(tag, str) for tag in tags)
+
+
+def make_tags(tags) -> frozenset:
+    return frozenset(tags) if tags else NO_TAGS
+
+
 class BroadcastComputer(PComputer):
-    def __init__(self, user_name, handler):
+    """
+    All computers of user or computers with any of tags.
+    Action is recorded once by ComputerHandler.broadcast, computers apply it on their next poll or push
+    """
+
+    __slots__ = ("user_name", "handler", "tags")
+
+    def __init__(self, user_name, handler, tags: List[str] = None):
         self.user_name = user_name
         self.handler: ComputerHandler = handler
+        self.tags = tags if tags is not None else []
+
+    def broadcast(self, action_type: ActionType, **kwargs):
+        self.handler.broadcast(self.user_name, Methods.gen_action(action_type, **kwargs), self.tags)
 
     def add_button(self, button_name, button_text):
-        computers = self.handler.get_user_computers(self.user_name)
-        for computer in computers:
-            computer.add_button(button_name, button_text)
+        self.broadcast(Methods.BUTTON_ADD, name=button_name, text=button_text)
+
+    def add_buttons(self, buttons: List[dict]):
+        self.broadcast(Methods.BUTTON_ADD_MANY, buttons=buttons)
+
+    def delete_button(self, button_name):
+        self.broadcast(Methods.BUTTON_DELETE, name=button_name)
+
+    def delete_all_buttons(self):
+        self.broadcast(Methods.BUTTON_DELETE_ALL)
 
     def press_button(self, button_name):
-        computers = self.handler.get_user_computers(self.user_name)
-        for computer in computers:
-            computer.press_button(button_name)
+        self.broadcast(Methods.BUTTON_CLICK, name=button_name)
 
     def disconnect(self):
-        computers = self.handler.get_user_computers(self.user_name)
-        for computer in computers:
-            computer.disconnect()
+        self.broadcast(Methods.COMPUTER_DISCONNECT)
 
 
 class Computer(PComputer):
-    def __init__(self, user_name, handler, adr, name, _id):
+    # One object for each connected computer, so attributes are stored in slots.
+    # Event is created by the first long poll and listeners are set by websocket agents only
+    __slots__ = ("adr", "id", "name", "nonce", "user_name", "handler", "lock", "last_seen", "heartbeat_saved",
+                 "online", "buttons", "tags", "broadcast_seq", "acks", "connected", "actions_event", "listeners",
+                 "deadline")
+
+    def __init__(self, user_name, handler, adr, name, _id, nonce: str = None):
         self.adr = adr
         self.id = _id
         self.name = name
+        # Ids are reused after disconnect, tokens are bound to nonce of computer instead
+        self.nonce = nonce if nonce is not None else new_nonce()
         self.user_name = user_name
         self.handler: "ComputerHandler" = handler
+        self.lock = handler.lock(user_name)
 
-        self.added_message = ""
-        self.added_message_timeout = 0
-
-        self.timeout = 20
+        self.last_seen = time()
+        self.heartbeat_saved = self.last_seen
+        self.online = True
 
         self.buttons = {}
-        self.actions = []
+        self.tags = NO_TAGS
+        # Seq of the last applied broadcast, new computer doesn't get broadcasts, that were sent before
+        self.broadcast_seq = handler.broadcast_seqs.get(user_name, 0)
+        # Agent acknowledges actions, so they are kept in queue until acknowledged
+        self.acks = False
+
+        self.connected = True
+        self.actions_event: Union[Event, None] = None
+        # Tuple is replaced on change, so it can be iterated without lock
+        self.listeners = ()
+
+        # The only valid deadline of computer in heap of handler, older entries are skipped
+        self.deadline = None
 
     def add_button(self, button_name, button_text):
-        self.buttons[button_name] = Button(button_name, button_text)
+        with self.lock:
+            self.buttons[button_name] = Button(button_name, button_text)
+        self.save_buttons()
+        self.notify_update()
+
+    def add_buttons(self, buttons: List[dict]):
+        """
+        Add many buttons with one update event
+
+        :param buttons: List of dicts with "name" and "text"
+        """
+
+        with self.lock:
+            for button in buttons:
+                self.buttons[button["name"]] = Button(button["name"], button["text"])
+        self.save_buttons()
+        self.notify_update()
+
+    def delete_button(self, button_name):
+        with self.lock:
+            if self.buttons.pop(button_name, None) is None:
+                return
+        self.save_buttons()
+        self.notify_update()
+
+    def delete_all_buttons(self):
+        with self.lock:
+            self.buttons.clear()
+        self.save_buttons()
+        self.notify_update()
+
+    def set_tags(self, tags: List[str]):
+        with self.lock:
+            self.tags = make_tags(tags)
+
+        self.handler.changed(self.user_name)
+        if self.handler.backend.shared:
+            self.handler.backend.set_tags(self.user_name, self.id, sorted(self.tags))
+        self.notify_update()
+
+    def save_buttons(self):
+        self.handler.changed(self.user_name)
+
+        if not self.handler.backend.shared:
+            return
+
+        with self.lock:
+            buttons = {button.name: button.text for button in self.buttons.values()}
+        self.handler.backend.set_buttons(self.user_name, self.id, buttons)
 
     def press_button(self, button_name):
-        self.buttons[button_name].click()
+        if button_name not in self.buttons and self.handler.backend.shared:
+            # Button may be added through other process after the last sync
+            self.handler.sync(self.user_name, force=True)
+
+        if button_name not in self.buttons:
+            return
+
+        self.handler.backend.click(self.user_name, self.id, button_name, coalesce=self.handler.coalesce_clicks)
+        self.wake()
+        self.push_actions()
 
     def disconnect(self):
-       self.handler.disconnect(self.user_name, self.id)
+        self.handler.disconnect(self.user_name, self.id, self)
+
+    def wake(self):
+        """
+        Wake long poll of computer, if it waits for actions
+        """
+
+        actions_event = self.actions_event
+        if actions_event is not None:
+            actions_event.set()
+
+    def add_listener(self, listener: Callable):
+        """
+        :param listener: Push listener (websocket agent), takes list of actions
+        """
+
+        with self.lock:
+            self.listeners += (listener,)
+
+    def remove_listener(self, listener: Callable):
+        with self.lock:
+            self.listeners = tuple(item for item in self.listeners if item is not listener)
+
+    @property
+    def timeout(self) -> float:
+        """
+        Seconds left before computer goes offline
+        """
+
+        return max(ONLINE_TIMEOUT - (time() - self.last_seen), 0) if self.online else 0
 
     def checked(self):
-        self.timeout = 20
+        self.last_seen = time()
+
+        if self.handler.backend.shared and self.last_seen - self.heartbeat_saved >= HEARTBEAT_SAVE_INTERVAL:
+            self.heartbeat_saved = self.last_seen
+            self.handler.backend.heartbeat(self.user_name, self.id, self.last_seen)
+
+        if not self.online and self.handler.set_online(self, True):
+            # Deadline of offline computer is its eviction, so the online timeout is scheduled again
+            self.handler.add_deadline(self.last_seen + ONLINE_TIMEOUT, self)
+            self.notify_update()
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            buttons = [{"name": button.name, "text": button.text} for button in self.buttons.values()]
+
+        return {"id": self.id, "name": self.name, "adr": self.adr, "timeout": round(self.timeout),
+                "online": self.online, "buttons": buttons, "tags": sorted(self.tags)}
+
+    def notify_update(self):
+        with self.lock:
+            version = self.handler.touch(self.user_name, self.id)
 
-    def parse_answer(self, data: dict):
-        ret = self.parse_action(data)
+        self.handler.notify(self.user_name, Events.gen_action(Events.COMPUTER_UPDATE, computer=self.to_dict(),
+                                                              version=self.handler.version_tag(version)))
+
+    def push_actions(self):
+        """
+        Send pending actions to all push listeners (websocket agents) at once
+        """
+
+        if not self.listeners:
+            return
+
+        actions = self.get_actions()
+        if not actions:
+            return
+
+        for listener in self.listeners:
+            listener(actions)
+
+    def ack(self, seq: int):
+        """
+        Delete actions up to seq, which were processed by agent
+        """
+
+        self.acks = True
+        clicks = self.handler.backend.ack_actions(self.user_name, self.id, seq)
+
+        with self.lock:
+            for button_name, clicks_count in clicks.items():
+                if button_name in self.buttons:
+                    self.buttons[button_name].all_click_count += clicks_count
+
+    def parse_answer(self, data: dict) -> list:
+        """
+        :param data: Request of agent. With "ack" (seq of the last processed action) not acknowledged actions
+                     are delivered again
+        """
+
+        if "ack" in data:
+            if not isinstance(data["ack"], int):
+                return [Errors.gen_action(Errors.NEED_ARGS, args=["ack"])]
+            self.ack(data["ack"])
+
+        if isinstance(data.get("actions"), list):
+            ret = self.parse_actions(data)
+        else:
+            ret = self.parse_action(data)
+
+        if ret is None:
+            ret = []
+        elif isinstance(ret, dict):
+            ret = [ret]
 
         if "get_actions" in data and data["get_actions"]:
-            ret.update(self.get_actions())
+            if "wait" in data:
+                ret.extend(self.wait_actions(data["wait"], "ack" in data))
+            else:
+                ret.extend(self.get_actions("ack" in data))
+
+        return ret
+
+    def parse_actions(self, data: dict) -> list:
+        """
+        Parse batch of actions from data["actions"] in order.
+        Other fields of data (user_name, hash_key, ...) are shared by all actions
+
+        :return: One result for each action: error or Results.OK
+        """
+
+        shared = {key: data[key] for key in data if key != "actions"}
+        ret = []
+
+        for action in data["actions"]:
+            if not isinstance(action, dict):
+                ret.append(Errors.gen_action(Errors.NEED_ARGS, args=["action"]))
+                continue
+
+            # Credentials are checked once for the whole request
+            if "user_name" in action or "hash_key" in action:
+                ret.append(Errors.gen_action(Errors.SHARED_ARGS, args=["user_name", "hash_key"]))
+                continue
+
+            result = self.parse_action(dict(shared, **action))
+            ret.append(result if isinstance(result, dict) and result.get("action") else Results.gen_action(Results.OK))
 
         return ret
 
@@ -201,180 +553,1054 @@ class Computer(PComputer):
         if "action" not in data:
             return []
 
-        broadcast = False
+        broadcast = data["action"] == "broadcast_method"
+
+        if data["action"] != "method" and not broadcast:
+            return []
+
+        val = Methods.parse(data, self.user_name)
+
+        if isinstance(val, dict):
+            return val
+
+        if val is None or val.executor is None:
+            return Errors.gen_action(Errors.UNKNOWN_METHOD, method=data.get("type"))
+
+        if broadcast and not is_tags(data.get("tags", [])):
+            return Errors.gen_action(Errors.NEED_ARGS, args=["tags"])
+
+        ret = val.executor(self, data, broadcast)
+
+        return [] if ret is None else ret
+
+    def catch_up(self):
+        """
+        Apply broadcasts of user, that were sent after the last call
+        """
+
+        seq = self.handler.broadcast_seqs.get(self.user_name, 0)
+        if self.broadcast_seq >= seq:
+            return
+
+        with self.lock:
+            after = self.broadcast_seq
+            if after >= seq:
+                return
+            self.broadcast_seq = seq
+
+        backend = self.handler.backend
+        after = backend.claim_broadcasts(self.user_name, self.id, after, seq)
+
+        for _, tags, action in backend.get_broadcasts(self.user_name, after, seq):
+            if not tags or not self.tags.isdisjoint(tags):
+                self.parse_action(action)
+
+    def get_actions(self, redeliver: bool = False) -> list:
+        """
+        :param redeliver: Return actions, which were delivered but not acknowledged, too
+        """
 
-        action = data["action"]
+        if self.actions_event is not None:
+            self.actions_event.clear()
 
-        if action == "broadcast_method":
-            broadcast = True
-            action = "method"
+        self.catch_up()
 
         ret = []
+        backend = self.handler.backend
 
-        if action == "method":
-            val = Methods.parse(data)
-
-            if isinstance(val, dict):
-                return val
-
-            if val == Methods.COMPUTER_DISCONNECT:
-                if not broadcast:
-                    self.disconnect()
-                return {"action": ""}
-
-            elif Methods.BUTTON_ADD == val:
-                if not broadcast:
-                    self.add_button(data["name"], data["text"])
-                else:
-                    self.handler.get_broadcast_computer(self.user_name).add_button(data["name"], data["text"])
-
-            elif Methods.BUTTON_DELETE == val:
-                if data["name"] in self.buttons:
-                    del self.buttons[data["name"]]
-                else:
-                    pass
-
-            elif Methods.BUTTON_DELETE_ALL == val:
-                for button_name in [_ for _ in self.buttons]:
-                    del self.buttons[button_name]
-            elif val == Methods.BUTTON_CLICK:
-                if not broadcast:
-                    self.press_button(data["name"])
-                else:
-                    self.handler.get_broadcast_computer(self.user_name).press_button(data["name"])
+        if self.acks:
+            clicks = backend.deliver_actions(self.user_name, self.id, redeliver)
+        else:
+            clicks = [(None, button_name, clicks_count)
+                      for button_name, clicks_count in backend.take_clicks(self.user_name, self.id).items()]
 
+        if not clicks:
             return ret
 
-    def get_actions(self) -> list:
-        ret = []
+        with self.lock:
+            for seq, button_name, clicks_count in clicks:
+                if button_name in self.buttons:
+                    ret.append(self.buttons[button_name].gen_action(clicks_count, seq))
+
+        return ret
+
+    def wait_actions(self, timeout, redeliver: bool = False) -> list:
+        """
+        Block until some button is clicked or timeout expires
+
+        :param timeout: Max wait time in seconds (limited by MAX_WAIT_TIMEOUT)
+        :param redeliver: Return not acknowledged actions too
+        :return: List of actions, maybe empty
+        """
+
+        try:
+            timeout = min(max(float(timeout), 0), MAX_WAIT_TIMEOUT)
+        except (TypeError, ValueError):
+            timeout = 0
+
+        if self.actions_event is None:
+            with self.lock:
+                if self.actions_event is None:
+                    self.actions_event = Event()
+
+        end_time = monotonic() + timeout
+        ret = self.get_actions(redeliver)
+
+        while not ret and self.connected:
+            if not self.actions_event.wait(end_time - monotonic()):
+                break
+            ret = self.get_actions()
 
-        for button_name in self.buttons:
-            button = self.buttons[button_name]
-            if button.click_count:
-                ret.append(button.gen_action())
-                button.click_count = 0
+        self.checked()
 
         return ret
 
 
+@Methods.register(Methods.COMPUTER_DISCONNECT)
+def computer_disconnect(computer: Computer, data: dict, broadcast: bool):
+    if not broadcast:
+        computer.disconnect()
+    return {"action": ""}
+
+
+@Methods.register(Methods.COMPUTER_GET_TOKEN)
+def computer_get_token(computer: Computer, data: dict, broadcast: bool):
+    tokens = computer.handler.tokens
+
+    if broadcast or tokens is None:
+        return Errors.gen_action(Errors.UNKNOWN_METHOD, method=data.get("type"))
+
+    token, expires = tokens.sign(computer.user_name, computer.id, computer.nonce)
+    return Results.gen_action(Results.TOKEN, token=token, id=computer.id, expires=expires)
+
+
+@Methods.register(Methods.COMPUTER_SET_TAGS)
+def computer_set_tags(computer: Computer, data: dict, broadcast: bool):
+    if not is_tags(data["tags"]):
+        return Errors.gen_action(Errors.NEED_ARGS, args=["tags"])
+
+    if not broadcast:
+        computer.set_tags(data["tags"])
+
+
+@Methods.register(Methods.BUTTON_ADD)
+def button_add(computer: Computer, data: dict, broadcast: bool):
+    if not broadcast:
+        computer.add_button(data["name"], data["text"])
+    else:
+        computer.handler.get_broadcast_computer(computer.user_name, data.get("tags")).add_button(data["name"],
+                                                                                                 data["text"])
+
+
+@Methods.register(Methods.BUTTON_ADD_MANY)
+def button_add_many(computer: Computer, data: dict, broadcast: bool):
+    buttons = data["buttons"]
+
+    if not isinstance(buttons, list) or \
+            not all(isinstance(button, dict) and isinstance(button.get("name"), str) and "text" in button
+                    for button in buttons):
+        return Errors.gen_action(Errors.NEED_ARGS, args=["name", "text"])
+
+    if not broadcast:
+        computer.add_buttons(buttons)
+    else:
+        computer.handler.get_broadcast_computer(computer.user_name, data.get("tags")).add_buttons(buttons)
+
+
+@Methods.register(Methods.BUTTON_DELETE)
+def button_delete(computer: Computer, data: dict, broadcast: bool):
+    if not broadcast:
+        computer.delete_button(data["name"])
+    else:
+        computer.handler.get_broadcast_computer(computer.user_name, data.get("tags")).delete_button(data["name"])
+
+
+@Methods.register(Methods.BUTTON_DELETE_ALL)
+def button_delete_all(computer: Computer, data: dict, broadcast: bool):
+    if not broadcast:
+        computer.delete_all_buttons()
+    else:
+        computer.handler.get_broadcast_computer(computer.user_name, data.get("tags")).delete_all_buttons()
+
+
+@Methods.register(Methods.BUTTON_RESET_CUR_COUNTER)
+def button_reset_cur_counter(computer: Computer, data: dict, broadcast: bool):
+    clicks = computer.handler.backend.take_pending_clicks(computer.user_name, computer.id, data.get("name"))
+
+    with computer.lock:
+        for button_name, clicks_count in clicks.items():
+            if button_name in computer.buttons:
+                computer.buttons[button_name].all_click_count += clicks_count
+
+
+@Methods.register(Methods.BUTTON_CLICK)
+def button_click(computer: Computer, data: dict, broadcast: bool):
+    if not broadcast:
+        computer.press_button(data["name"])
+    else:
+        computer.handler.get_broadcast_computer(computer.user_name, data.get("tags")).press_button(data["name"])
+
+
 class ComputerHandler:
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, backend: StateBackend = None, coalesce_clicks: bool = True,
+                 snapshot_path: str = None, max_computers: int = None, tokens: TokenSigner = None):
+        """
+        :param debug: Debug mode
+        :param backend: State backend, MemoryBackend by default
+        :param coalesce_clicks: Not delivered clicks of one button are sent as one action with count
+        :param snapshot_path: Path to snapshot of computers, that is restored on run.
+                              Only for not shared backend, shared backends keep computers themselves
+        :param max_computers: Max count of computers of one user, None for no limit
+        :param tokens: Signer of agent tokens, without it agents can't get tokens
+        """
+
         self.debug = debug
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.coalesce_clicks = coalesce_clicks
+        self.max_computers = max_computers
+        self.tokens = tokens
+
+        self.snapshot = Snapshot(snapshot_path) if snapshot_path and not self.backend.shared else None
+        # Users, whose computers were changed after the last snapshot
+        self.changed_users = set()
+        self.changed_users_lock = Lock()
+
         self.computers = {}
+        self.listeners = {}
+
+        # Indexes of computers in local registry, updated on add, remove and change of online state.
+        # Values are ids, or lists of ids if key is not unique, because most keys have one computer.
+        # Processes with shared backend may create computers with the same address at the same time
+        # user name -> {address: ids}
+        self.by_adr = {}
+        # user name -> {name: ids}
+        self.by_name = {}
+        # user name -> (ids of offline computers, ids of online computers), so it is indexed by computer.online
+        self.by_state = {}
+
+        # user name -> time of the last sync with shared backend
+        self.synced = {}
+
+        # Versions are counted by each process, so version tag has id of the process
+        self.epoch = os.urandom(4).hex()
+        # user name -> version of the last change of user computers
+        self.versions = {}
+        # user name -> {computer id: (version, removed)}, the last changed computer is the last key
+        self.changes = {}
+
+        # user name -> seq of the last broadcast, known by this process
+        self.broadcast_seqs = {}
+        # Users, whose waiting computers must be woken after broadcast
+        self.broadcast_queue = SimpleQueue()
+
+        self.locks = [RLock() for _ in range(LOCK_SHARDS_COUNT)]
+
+        # Heap of (deadline, counter, computer), counter makes entries comparable
+        self.deadlines = []
+        self.deadlines_counter = count()
+        self.deadlines_condition = Condition()
+
+    def lock(self, user_name) -> RLock:
+        """
+        All computers of one user are protected by one lock, different users are spread between LOCK_SHARDS_COUNT locks
 
-        self.cached_id = {}
+        :param user_name: User name
+        :return: RLock of user
+        """
+
+        return self.locks[hash(user_name) % LOCK_SHARDS_COUNT]
 
     def run(self):
+        if self.snapshot is not None:
+            self.restore_snapshot()
+            Thread(target=self.snapshotter, daemon=True).start()
+            atexit.register(self.save_snapshot)
+
         Thread(target=self.checker, daemon=True).start()
+        Thread(target=self.broadcaster, daemon=True).start()
+
+        if self.backend.shared:
+            Thread(target=self.pending_checker, daemon=True).start()
+
+    def add_deadline(self, deadline: float, computer: Computer):
+        """
+        Schedule check of computer at deadline (time.time)
+        """
+
+        with self.deadlines_condition:
+            computer.deadline = deadline
+            heappush(self.deadlines, (deadline, next(self.deadlines_counter), computer))
+
+            if self.deadlines[0][2] is computer:
+                self.deadlines_condition.notify()
+
+    def add_deadlines(self, deadline: float, computers: List[Computer]):
+        """
+        Schedule check of many computers at one deadline
+        """
+
+        with self.deadlines_condition:
+            for computer in computers:
+                computer.deadline = deadline
+
+            self.deadlines.extend((deadline, next(self.deadlines_counter), computer) for computer in computers)
+            heapify(self.deadlines)
+
+            self.deadlines_condition.notify()
 
     def checker(self):
-        iters = 0
+        """
+        Sleep until the nearest deadline and check only computers, which are due.
+        Computer that wasn't checked for ONLINE_TIMEOUT goes offline, after EVICT_TIMEOUT it is disconnected
+        """
 
         while True:
-            sleep(5)
-            iters += 1
+            with self.deadlines_condition:
+                while not self.deadlines or self.deadlines[0][0] > time():
+                    self.deadlines_condition.wait(self.deadlines[0][0] - time() if self.deadlines else None)
+
+                deadline, _, computer = heappop(self.deadlines)
 
-            if not iters % 100:
-                self.clear_cached_id_all()
+                # Deadline was replaced by a newer one
+                if computer.deadline != deadline:
+                    continue
 
-            computers = self.computers.copy()
-            for user_i in computers:
-                for comp_adr in computers[user_i]:
-                    comp = self.computers[user_i][comp_adr]
+            try:
+                self.expire(computer)
+            except Exception:
+                self.log_error("checker")
+                self.add_deadline(time() + ERROR_RETRY_INTERVAL, computer)
 
-                    if comp.timeout > 0:
-                        comp.timeout -= 5
+    def changed(self, user_name):
+        """
+        Mark computers of user to be saved by the next snapshot
+        """
 
-    def connect(self, user_name, adr, name) -> Computer:
-        if user_name not in self.computers:
-            self.computers[user_name] = {}
-            self.computers[user_name][0] = BroadcastComputer(user_name, self)
+        if self.snapshot is not None:
+            with self.changed_users_lock:
+                self.changed_users.add(user_name)
 
-        comp_id = None
-        for i in range(len(self.computers[user_name])):
-            if i not in self.computers[user_name]:
-                comp_id = i
-                break
-        if comp_id is None:
-            comp_id = len(self.computers[user_name]) + 1
+    def dump_user(self, user_name) -> List[list]:
+        """
+        :return: Computers of user in snapshot format
+        """
 
-        self.computers[user_name][comp_id] = Computer(user_name, self, adr, name, comp_id)
+        with self.lock(user_name):
+            return [[comp.id, comp.adr, comp.name, {button.name: button.text for button in comp.buttons.values()},
+                     sorted(comp.tags), comp.nonce]
+                    for comp in self.computers.get(user_name, {}).values() if isinstance(comp, Computer)]
 
-        self.add_cached_id(user_name, adr, comp_id)
+    def save_snapshot(self, rewrite: bool = False):
+        """
+        Append changed users to snapshot or rewrite it, if it has too many old lines
 
-        return self.computers[user_name][comp_id]
+        :param rewrite: Rewrite snapshot anyway
+        """
 
-    def disconnect(self, user_name, _id):
-        self.clear_cached_id_for(user_name, _id)
-        del self.computers[user_name][_id]
+        with self.changed_users_lock:
+            users, self.changed_users = self.changed_users, set()
+
+        try:
+            if rewrite or self.snapshot.need_rewrite(len(self.computers)):
+                self.snapshot.write({user_name: self.dump_user(user_name) for user_name in list(self.computers)})
+            elif users:
+                self.snapshot.append({user_name: self.dump_user(user_name) for user_name in users})
+        except Exception:
+            # Users are saved by the next snapshot
+            with self.changed_users_lock:
+                self.changed_users.update(users)
+            raise
+
+    def restore_snapshot(self):
+        """
+        Load computers from snapshot, so agents can continue without adding buttons again.
+        Computers are offline until their agents connect
+        """
 
-    def get_user_computers(self, user_name) -> List[Computer]:
-        return [self.computers[user_name][i] for i in self.computers[user_name] if i != 0] \
-            if user_name in self.computers else []
+        # Restored computers are offline, so the first deadline is the eviction
+        last_seen = time() - ONLINE_TIMEOUT
+        restored = []
+
+        # Objects are only created here, collections would take more time than loading
+        gc_enabled = gc.isenabled()
+        gc.disable()
+
+        try:
+            for user_name, computers in self.snapshot.load().items():
+                with self.lock(user_name):
+                    # Snapshots of older versions have no nonce, new one invalidates old tokens
+                    for _id, adr, name, buttons, tags, *nonce in computers:
+                        restored.append(self.load_computer(user_name, {
+                            "id": _id, "adr": adr, "name": name, "buttons": buttons, "tags": tags, "broadcast_seq": 0,
+                            "last_seen": last_seen, "nonce": nonce[0] if nonce else new_nonce()}, schedule=False))
+
+                    self.backend.restore_ids(user_name, [computer[0] for computer in computers])
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        self.add_deadlines(last_seen + EVICT_TIMEOUT, restored)
+        with self.changed_users_lock:
+            self.changed_users = set()
+
+    @staticmethod
+    def log_error(thread_name: str):
+        """
+        Log exception of background thread, thread continues with the next iteration
+        """
+
+        handler_logger.log(f"Error in {thread_name}:\n", traceback.format_exc())
+
+    def snapshotter(self):
+        # The first rewrite compacts snapshot and drops the last line, if it was written partially
+        rewrite = True
 
-    def get_broadcast_computer(self, user_name) -> Union[BroadcastComputer, None]:
-        if user_name in self.computers:
-            return self.computers[user_name][0]
+        while True:
+            try:
+                self.save_snapshot(rewrite)
+                rewrite = False
+            except Exception:
+                self.log_error("snapshotter")
+
+            sleep(SNAPSHOT_INTERVAL)
 
-    def add_cached_id(self, user_name: str, adr: str, _id: int):
+    def broadcast(self, user_name, action: dict, tags: List[str] = None):
         """
-        Add computer id to cache
+        Record action for all computers of user once. Computers apply it on their next get_actions,
+        so request doesn't depend on count of computers. Waiting computers are woken by broadcaster thread
 
         :param user_name: User name
-        :param adr: Computer address
-        :param _id: Computer id in this web app
-        :return: None
+        :param action: Method action
+        :param tags: Action is applied only to computers with any of tags
+        """
+
+        now = time()
+        seq = self.backend.add_broadcast(user_name, action, tags or [], now)
+        self.backend.trim_broadcasts(user_name, now - BROADCAST_KEEP_TIME)
+
+        self.add_broadcast_seq(user_name, seq)
+
+    def add_broadcast_seq(self, user_name, seq: int):
+        with self.lock(user_name):
+            if seq <= self.broadcast_seqs.get(user_name, 0):
+                return
+            self.broadcast_seqs[user_name] = seq
+
+        self.broadcast_queue.put(user_name)
+
+    def broadcaster(self):
         """
+        Wake computers, that wait for actions in long poll or websocket, after broadcast.
+        Other computers will apply broadcast on the next poll
+        """
+
+        while True:
+            user_name = self.broadcast_queue.get()
+
+            try:
+                with self.lock(user_name):
+                    computers = [comp for comp in self.computers.get(user_name, {}).values()
+                                 if isinstance(comp, Computer) and (comp.actions_event is not None or comp.listeners)]
 
-        if user_name not in self.cached_id:
-            self.cached_id[user_name] = {}
-        self.cached_id[user_name][adr] = _id
+                for computer in computers:
+                    computer.wake()
+                    computer.push_actions()
+            except Exception:
+                self.log_error("broadcaster")
+
+    def pending_checker(self):
+        """
+        Wake computers of this process, which got clicks or broadcasts through other processes (shared backend only)
+        """
 
-    def clear_cached_id(self, user_name):
-        if user_name in self.cached_id:
-            del self.cached_id[user_name]
+        broadcast_seq = 0
 
-    def clear_cached_id_for(self, user_name, _id):
-        if user_name not in self.cached_id:
+        while True:
+            sleep(PENDING_CHECK_INTERVAL)
+
+            try:
+                for user_name, seq in self.backend.broadcasts_after(broadcast_seq):
+                    broadcast_seq = max(broadcast_seq, seq)
+                    self.add_broadcast_seq(user_name, seq)
+
+                for user_name, _id in self.backend.pending():
+                    with self.lock(user_name):
+                        computer = self.computers.get(user_name, {}).get(_id)
+
+                    if isinstance(computer, Computer):
+                        computer.wake()
+                        computer.push_actions()
+            except Exception:
+                self.log_error("pending_checker")
+                sleep(ERROR_RETRY_INTERVAL)
+
+    def expire(self, computer: Computer):
+        if not computer.connected:
             return
 
-        if _id in self.cached_id[user_name]:
-            del self.cached_id[user_name][_id]
+        if self.backend.shared:
+            last_seen = self.backend.get_last_seen(computer.user_name, computer.id)
+
+            if last_seen is None:
+                self.remove_computer(computer.user_name, computer.id, computer)
+                return
+
+            computer.last_seen = max(computer.last_seen, last_seen)
+
+        now = time()
+
+        with computer.lock:
+            if computer.online:
+                deadline = computer.last_seen + ONLINE_TIMEOUT
+
+                if deadline <= now:
+                    self.set_online(computer, False)
+                    deadline = computer.last_seen + EVICT_TIMEOUT
+            else:
+                deadline = computer.last_seen + EVICT_TIMEOUT
+
+                if deadline <= now:
+                    deadline = None
+
+        if deadline is None:
+            computer.disconnect()
+            return
+
+        self.add_deadline(deadline, computer)
+
+        if not computer.online:
+            computer.notify_update()
+
+    def add_computer(self, computer: Computer, schedule: bool = True):
+        """
+        Add computer to local registry. Lock of user must be acquired
+
+        :param schedule: Add deadline of computer, otherwise caller must add it
+        """
+
+        if computer.user_name not in self.computers:
+            self.computers[computer.user_name] = {0: BroadcastComputer(computer.user_name, self)}
+            self.by_adr[computer.user_name] = {}
+            self.by_name[computer.user_name] = {}
+            self.by_state[computer.user_name] = (set(), set())
+
+        old_computer = self.computers[computer.user_name].get(computer.id)
+        if isinstance(old_computer, Computer):
+            self.unindex_computer(old_computer)
+
+        self.computers[computer.user_name][computer.id] = computer
+        self.index_computer(computer)
+
+        if schedule:
+            self.add_deadline(computer.last_seen + ONLINE_TIMEOUT, computer)
+        self.changed(computer.user_name)
+        self.touch(computer.user_name, computer.id)
+
+    def create_computer(self, user_name, adr, name) -> Union[Computer, None]:
+        """
+        Create computer with the smallest free id. Lock of user must be acquired
+
+        :return: Computer or None, if user already has max_computers computers
+        """
+
+        # Broadcast computer with id 0 is not counted
+        if self.max_computers is not None and len(self.computers.get(user_name, ())) > self.max_computers:
+            return None
+
+        last_seen, nonce = time(), new_nonce()
+        comp_id = self.backend.add_computer(user_name, adr, name, last_seen, nonce)
+
+        computer = Computer(user_name, self, adr, name, comp_id, nonce)
+        computer.last_seen = computer.heartbeat_saved = last_seen
+        self.add_computer(computer)
+
+        return computer
+
+    def load_computer(self, user_name, data: dict, schedule: bool = True) -> Computer:
+        """
+        Create local view of computer from backend data. Lock of user must be acquired
+
+        :param schedule: Add deadline of computer, otherwise caller must add it
+        """
+
+        computer = Computer(user_name, self, data["adr"], data["name"], data["id"], data["nonce"])
+        computer.last_seen = computer.heartbeat_saved = data["last_seen"]
+        computer.online = computer.timeout > 0
+        computer.buttons = {name: Button(name, text) for name, text in data["buttons"].items()}
+        computer.tags = make_tags(data["tags"])
+        computer.broadcast_seq = data["broadcast_seq"]
+
+        self.add_computer(computer, schedule)
+
+        return computer
+
+    def sync(self, user_name, force: bool = False):
+        """
+        Update local view of user computers from shared backend, at most once per SYNC_INTERVAL
+
+        :param user_name: User name
+        :param force: Ignore SYNC_INTERVAL
+        """
+
+        if not self.backend.shared:
+            return
+
+        now = time()
+        if not force and now - self.synced.get(user_name, 0) < SYNC_INTERVAL:
+            return
+        self.synced[user_name] = now
+
+        computers = self.backend.get_computers(user_name)
+        updated = []
+        removed = []
+
+        with self.lock(user_name):
+            local_computers = self.computers.get(user_name, {})
+
+            for data in computers:
+                computer = local_computers.get(data["id"])
+
+                if computer is None:
+                    updated.append(self.load_computer(user_name, data))
+                    continue
+
+                computer.last_seen = max(computer.last_seen, data["last_seen"])
+
+                if {button.name: button.text for button in computer.buttons.values()} != data["buttons"] or \
+                        computer.tags != make_tags(data["tags"]):
+                    computer.buttons = {name: Button(name, text) for name, text in data["buttons"].items()}
+                    computer.tags = make_tags(data["tags"])
+                    updated.append(computer)
+
+            ids = {data["id"] for data in computers}
+            removed = [computer for _id, computer in local_computers.items() if _id != 0 and _id not in ids]
+
+        for computer in updated:
+            computer.notify_update()
+
+        for computer in removed:
+            self.remove_computer(user_name, computer.id, computer)
+
+    def connect(self, user_name, adr, name) -> Union[Computer, None]:
+        """
+        :return: New computer or None, if user already has max_computers computers
+        """
+
+        with self.lock(user_name):
+            computer = self.create_computer(user_name, adr, name)
+
+        if computer is not None:
+            computer.notify_update()
+
+        return computer
+
+    def disconnect(self, user_name, _id, computer: Computer = None):
+        """
+        :param user_name: User name
+        :param _id: Computer id
+        :param computer: If passed, computer is disconnected only if its id wasn't reused yet
+        """
+
+        with self.lock(user_name):
+            if _id == 0 or _id not in self.computers.get(user_name, {}):
+                return
+
+            if computer is not None and self.computers[user_name][_id] is not computer:
+                return
+
+            computer = self.computers[user_name][_id]
+            self.backend.remove_computer(user_name, _id)
+
+        self.remove_computer(user_name, _id, computer)
+
+    def remove_computer(self, user_name, _id, computer: Computer = None):
+        """
+        Remove computer from local registry only
+        """
+
+        with self.lock(user_name):
+            if _id == 0 or _id not in self.computers.get(user_name, {}):
+                return
+
+            if computer is not None and self.computers[user_name][_id] is not computer:
+                return
+
+            computer = self.computers[user_name].pop(_id)
+
+            self.unindex_computer(computer)
+
+            computer.connected = False
+            computer.wake()
+
+            version = self.touch(user_name, _id, removed=True)
+
+        self.changed(user_name)
+        self.notify(user_name, Events.gen_action(Events.COMPUTER_DISCONNECT, id=_id, version=self.version_tag(version)))
+
+    def touch(self, user_name, _id, removed: bool = False) -> int:
+        """
+        Record change of computer for deltas of dashboard. Lock of user must be acquired
+
+        :param removed: Computer was removed
+        :return: New version of user computers
+        """
+
+        version = self.versions[user_name] = self.versions.get(user_name, 0) + 1
+
+        changes = self.changes.get(user_name)
+        if changes is None:
+            changes = self.changes[user_name] = {}
+
+        # Ids are reused, so there is one entry for each id ever used by user
+        changes.pop(_id, None)
+        changes[_id] = (version, removed)
+
+        return version
+
+    def version_tag(self, version: int) -> str:
+        return f"{self.epoch}-{version}"
+
+    def parse_version_tag(self, tag: str) -> Union[int, None]:
+        """
+        :return: Version or None, if tag is not valid or was made by other process
+        """
+
+        epoch, _, version = tag.strip('"').partition("-")
+
+        if epoch != self.epoch or not version.isdigit():
+            return None
+
+        return int(version)
+
+    def list_computers(self, user_name, since: int = None, online: bool = None, after: int = 0,
+                       limit: int = 100) -> dict:
+        """
+        List computers of user. If since is passed, only computers changed after this version are listed,
+        so cost of listing depends on count of changes, not on count of computers
+
+        :param since: Version, that client already has. None or unknown version for the full listing
+        :param online: List only online (True) or offline (False) computers
+        :param after: Full listing only: list computers with id greater than after
+        :param limit: Full listing only: max count of computers
+        :return: {"version": tag, "full": bool, "computers": [computer dicts], "removed": [ids], "next": id or None},
+                 "next" is the value of after for the next page. In delta computers, that don't match filter, are
+                 listed as removed
+        """
+
+        self.sync(user_name)
+
+        with self.lock(user_name):
+            version = self.versions.get(user_name, 0)
+            user_computers = self.computers.get(user_name, {})
+            full = since is None or since > version
+
+            computers = []
+            removed = []
+            next_id = None
+
+            if full:
+                ids = self.ids_by_state(user_name, online) if online is not None else user_computers
+                ids = nsmallest(limit + 1, (_id for _id in ids if _id > after))
+
+                computers = [user_computers[_id] for _id in ids[:limit] if _id != 0]
+                if len(ids) > limit:
+                    next_id = ids[limit - 1]
+            else:
+                for _id, (change_version, _) in reversed(self.changes.get(user_name, {}).items()):
+                    if change_version <= since:
+                        break
+
+                    computer = user_computers.get(_id)
+
+                    if not isinstance(computer, Computer) or online is not None and computer.online != online:
+                        removed.append(_id)
+                    else:
+                        computers.append(computer)
+
+        return {"version": self.version_tag(version), "full": full, "computers": [comp.to_dict() for comp in computers],
+                "removed": removed, "next": next_id}
+
+    def select_computers(self, user_name, ids: List[int] = None, name: str = None, adr: str = None,
+                         online: bool = None, tags: List[str] = None) -> List[Computer]:
+        """
+        Find computers of user by ids or by selector. All conditions of selector must match
+
+        :param ids: Ids of computers, other arguments are ignored
+        :param name: Glob pattern of computer name, for example "lab-*"
+        :param adr: Prefix of computer address
+        :param online: Select only online (True) or offline (False) computers
+        :param tags: Select computers with any of tags
+        :return: Found computers, sorted by id if selected by selector
+        """
+
+        self.sync(user_name)
+
+        with self.lock(user_name):
+            computers = self.computers.get(user_name, {})
+
+            if ids is not None:
+                return [computers[_id] for _id in ids if _id != 0 and _id in computers]
+
+            tags = make_tags(tags)
+
+            # The smallest indexed set of candidates, other conditions are checked for each candidate
+            if name is not None and not any(sym in name for sym in "*?["):
+                candidates = self.ids_by_name(user_name, name)
+            elif online is not None:
+                candidates = self.ids_by_state(user_name, online)
+            else:
+                candidates = computers
+
+            return [comp for comp in (computers[_id] for _id in sorted(candidates))
+                    if isinstance(comp, Computer)
+                    and (name is None or fnmatchcase(comp.name, name))
+                    and (adr is None or comp.adr.startswith(adr))
+                    and (online is None or comp.online == online)
+                    and (not tags or not tags.isdisjoint(comp.tags))]
+
+    def press_buttons(self, user_name, button_name, computers: List[Computer]) -> List[Computer]:
+        """
+        Click button of many computers, clicks are added to backend at once
+
+        :return: Computers, that have the button and were clicked
+        """
+
+        if self.backend.shared and any(button_name not in comp.buttons for comp in computers):
+            # Button may be added through other process after the last sync
+            self.sync(user_name, force=True)
+
+        with self.lock(user_name):
+            computers = [comp for comp in computers if button_name in comp.buttons]
+
+        self.backend.click_many(user_name, [comp.id for comp in computers], button_name,
+                                coalesce=self.coalesce_clicks)
+
+        for computer in computers:
+            computer.wake()
+            computer.push_actions()
 
-    def clear_cached_id_all(self):
-        for user_name in self.computers.copy():
-            self.clear_cached_id(user_name)
+        return computers
 
-    def get_computer(self, user_name, adr=None, _id=None, create_new: bool = False, name: str = None) -> Union[Computer, None]:
+    def subscribe(self, user_name, listener):
+        """
+        Add listener for user computers events (dashboard websocket)
+
+        :param user_name: User name
+        :param listener: Callable, takes event action dict
+        :return: None
+        """
+
+        with self.lock(user_name):
+            if user_name not in self.listeners:
+                self.listeners[user_name] = []
+            self.listeners[user_name].append(listener)
+
+    def unsubscribe(self, user_name, listener):
+        with self.lock(user_name):
+            if user_name in self.listeners and listener in self.listeners[user_name]:
+                self.listeners[user_name].remove(listener)
+
+    def notify(self, user_name, event: dict):
+        with self.lock(user_name):
+            listeners = self.listeners.get(user_name, []).copy()
+
+        for listener in listeners:
+            listener(event)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: Count of users, connected and online computers and dashboard listeners in this process
+        """
+
+        users = computers = online = 0
+
+        for user_name in list(self.computers):
+            with self.lock(user_name):
+                offline_ids, online_ids = self.by_state[user_name]
+
+                users += 1
+                computers += len(offline_ids) + len(online_ids)
+                online += len(online_ids)
+
+        listeners = sum(len(listeners) for listeners in list(self.listeners.values()))
+
+        return {"users": users, "computers": computers, "online": online, "listeners": listeners}
+
+    def get_user_computers(self, user_name) -> List[Computer]:
+        self.sync(user_name)
+
+        with self.lock(user_name):
+            return [self.computers[user_name][i] for i in self.computers[user_name] if i != 0] \
+                if user_name in self.computers else []
+
+    def get_broadcast_computer(self, user_name, tags: List[str] = None) -> Union[BroadcastComputer, None]:
+        """
+        :param tags: If passed, broadcast computer only for computers with any of tags
+        """
+
+        if tags:
+            return BroadcastComputer(user_name, self, tags)
+
+        with self.lock(user_name):
+            if user_name in self.computers:
+                return self.computers[user_name][0]
+
+    @staticmethod
+    def add_to_index(index: dict, key, _id: int):
+        ids = index.get(key)
+
+        if ids is None:
+            index[key] = _id
+        elif isinstance(ids, list):
+            ids.append(_id)
+        else:
+            index[key] = [ids, _id]
+
+    @staticmethod
+    def remove_from_index(index: dict, key, _id: int):
+        ids = index.get(key)
+
+        if ids == _id:
+            del index[key]
+        elif isinstance(ids, list) and _id in ids:
+            ids.remove(_id)
+            if len(ids) == 1:
+                index[key] = ids[0]
+
+    @staticmethod
+    def index_ids(index: dict, key) -> List[int]:
+        ids = index.get(key)
+
+        if ids is None:
+            return []
+        return list(ids) if isinstance(ids, list) else [ids]
+
+    def index_computer(self, computer: Computer):
+        """
+        Add computer to indexes. Lock of user must be acquired
+        """
+
+        self.add_to_index(self.by_adr[computer.user_name], computer.adr, computer.id)
+        self.add_to_index(self.by_name[computer.user_name], computer.name, computer.id)
+        self.by_state[computer.user_name][computer.online].add(computer.id)
+
+    def unindex_computer(self, computer: Computer):
+        """
+        Remove computer from indexes. Lock of user must be acquired
+        """
+
+        self.remove_from_index(self.by_adr[computer.user_name], computer.adr, computer.id)
+        self.remove_from_index(self.by_name[computer.user_name], computer.name, computer.id)
+        self.by_state[computer.user_name][computer.online].discard(computer.id)
+
+    def set_online(self, computer: Computer, online: bool) -> bool:
+        """
+        Change online state of computer and its index
+
+        :return: True if state was changed
+        """
+
+        with self.lock(computer.user_name):
+            if computer.online == online:
+                return False
+
+            computer.online = online
+
+            if self.computers.get(computer.user_name, {}).get(computer.id) is computer:
+                states = self.by_state[computer.user_name]
+                states[not online].discard(computer.id)
+                states[online].add(computer.id)
+
+        return True
+
+    def ids_by_name(self, user_name, name: str) -> List[int]:
+        """
+        :return: Ids of computers with name. Lock of user must be acquired
+        """
+
+        return self.index_ids(self.by_name.get(user_name, {}), name)
+
+    def ids_by_state(self, user_name, online: bool) -> set:
+        """
+        :return: Ids of online or offline computers. Lock of user must be acquired
+        """
+
+        states = self.by_state.get(user_name)
+        return states[online] if states is not None else set()
+
+    def get_computer_by_token(self, token) -> Union[Computer, None]:
+        """
+        Find computer of agent token without database and session
+
+        :return: Computer or None, if token is not valid or its computer was disconnected
+        """
+
+        claims = self.tokens.verify(token) if self.tokens is not None else None
+        if claims is None:
+            return None
+
+        user_name, _id, nonce = claims
+        computer = self.get_computer(user_name, _id=_id)
+
+        # Id could be reused by other computer after disconnect, id 0 is the broadcast computer
+        if not isinstance(computer, Computer) or computer.nonce != nonce:
+            return None
+
+        return computer
+
+    def find_computer(self, user_name, adr=None, _id=None) -> Union[Computer, None]:
+        """
+        Find computer in local registry by id or address
+        """
+
+        with self.lock(user_name):
+            if user_name not in self.computers:
+                return None
+
+            computers = self.computers[user_name]
+
+            if _id is None:
+                ids = self.index_ids(self.by_adr[user_name], adr)
+                _id = ids[0] if ids else None
+
+            return computers.get(_id) if _id != 0 else None
+
+    def get_computer(self, user_name, adr=None, _id=None, create_new: bool = False,
+                     name: str = None) -> Union[Computer, BroadcastComputer, None]:
         """
         :param user_name: User name
         :param adr: Computer address
+        :param _id: Computer id, id 0 is the broadcast computer of all computers of user
         :param create_new: If computer not exists, he will be created
         :param name: Name of new computer (if create_new == True)
-        :return: Computer or None
+        :return: Computer or None (also if new computer can't be created because of max_computers)
         """
 
-        if user_name in self.computers:
-            if _id is not None:
-                print(self.computers[user_name])
-                if _id in self.computers[user_name]:
-                    return self.computers[user_name][_id]
-                return None
+        if _id == 0:
+            return self.get_broadcast_computer(user_name)
+
+        self.sync(user_name)
+
+        computer = self.find_computer(user_name, adr, _id)
+
+        if computer is None and self.backend.shared:
+            # Computer may be created by other process after the last sync
+            self.sync(user_name, force=True)
+            computer = self.find_computer(user_name, adr, _id)
+
+        if computer is not None or not create_new:
+            return computer
+
+        with self.lock(user_name):
+            computer = self.find_computer(user_name, adr, _id)
 
-            if user_name in self.cached_id:
-                if adr in self.cached_id[user_name]:
-                    _id = self.cached_id[user_name][adr]
-                    if _id in self.computers[user_name]:
-                        return self.computers[user_name][_id]
-                    return None
+            if computer is not None:
+                return computer
 
-            for comp in [self.computers[user_name][i] for i in self.computers[user_name]]:
-                if comp.adr == adr:
-                    self.add_cached_id(user_name, adr, comp.id)
-                    return comp
+            computer = self.create_computer(user_name, adr, name)
 
-        if create_new:
-            return self.connect(user_name, adr, name)
+        if computer is not None:
+            computer.notify_update()
 
-        return None
+        return computer
@@ -0,0 +1,55 @@
+import json
+
+from socket import gethostbyname_ex, gethostname
+
+
+default_config = {
+    "ip": "",
+    "port": 5000,
+
+    "workers": 1,
+    "threads": 100,
+    "worker_class": "gthread",
+    "keepalive": 20,
+    "timeout": 30,
+
+    "state_backend": "memory",
+    "state_path": "state.db",
+    "coalesce_clicks": True,
+    "snapshot_path": "snapshot.jsonl.gz",
+
+    # [requests per second, burst], null disables limit
+    "address_rate_limit": [50, 100],
+    "user_rate_limit": [2000, 4000],
+    "login_rate_limit": [0.5, 5],
+    "max_computers": 1000,
+
+    # PBKDF2 iterations of new password hashes, older hashes are updated on login
+    "password_iterations": 600000,
+    "password_workers": 2,
+
+    # Secret of agent tokens, must be the same for all servers. Empty for the app secret key
+    "token_secret": "",
+    "token_ttl": 86400
+}
+
+
+def load_config(path: str = "config.json") -> dict:
+    """
+    Load server config. If file not exists, it will be created with default values
+
+    :param path: Path to config file
+    :return: Config dict, missing keys are filled with default values
+    """
+
+    config = default_config.copy()
+
+    try:
+        with open(path) as file:
+            config.update(json.load(file))
+    except FileNotFoundError:
+        with open(path, 'w') as file:
+            json.dump(default_config, file, indent=4)
+        print(f"You can try address: {gethostbyname_ex(gethostname())[-1][0]}")
+
+    return config
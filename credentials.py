@@ -0,0 +1,203 @@
+import hashlib
+import hmac
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from threading import BoundedSemaphore, Lock
+from typing import Union, Callable
+
+
+@lru_cache(maxsize=100000)
+def login_digest(login: str) -> str:
+    """
+    Users are stored by sha256 of login, digest of each login is computed once
+
+    :return: Hex sha256 of login
+    """
+
+    return hashlib.sha256(login.encode()).hexdigest()
+
+
+def gevent_patched() -> bool:
+    """
+    :return: True if threads are patched by gevent, so ThreadPoolExecutor would run hashing in greenlets
+    """
+
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+
+    return monkey.is_module_patched("threading")
+
+
+class Hasher:
+    """
+    Password hashing scheme. Stored hash of scheme starts with "<name>$"
+    """
+
+    name = ""
+
+    def hash(self, password: str) -> str:
+        pass
+
+    def verify(self, password: str, stored: str) -> bool:
+        pass
+
+    def needs_update(self, stored: str) -> bool:
+        """
+        :return: True if stored hash must be replaced with hash of the current settings
+        """
+
+        return False
+
+    def identify(self, stored: str) -> bool:
+        return stored.startswith(self.name + "$")
+
+
+class Sha256Hasher(Hasher):
+    """
+    Unsalted sha256 of old versions, stored as bare hex digest. Only verified, so rows can be migrated on login
+    """
+
+    name = "sha256"
+
+    def hash(self, password: str) -> str:
+        return hashlib.sha256(password.encode()).hexdigest()
+
+    def verify(self, password: str, stored: str) -> bool:
+        return hmac.compare_digest(self.hash(password), stored)
+
+    def needs_update(self, stored: str) -> bool:
+        return True
+
+    def identify(self, stored: str) -> bool:
+        return "$" not in stored
+
+
+class PBKDF2Hasher(Hasher):
+    """
+    Salted PBKDF2-HMAC-SHA256, stored as "pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>"
+    """
+
+    name = "pbkdf2_sha256"
+
+    def __init__(self, iterations: int = 600000, salt_size: int = 16):
+        """
+        :param iterations: Cost of hashing, hashes with other iterations are updated on login
+        :param salt_size: Salt size in bytes
+        """
+
+        self.iterations = iterations
+        self.salt_size = salt_size
+
+    def derive(self, password: str, salt: bytes, iterations: int) -> str:
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations).hex()
+
+    def hash(self, password: str) -> str:
+        salt = os.urandom(self.salt_size)
+        return f"{self.name}${self.iterations}${salt.hex()}${self.derive(password, salt, self.iterations)}"
+
+    def verify(self, password: str, stored: str) -> bool:
+        try:
+            _, iterations, salt, digest = stored.split("$")
+            return hmac.compare_digest(self.derive(password, bytes.fromhex(salt), int(iterations)), digest)
+        except ValueError:
+            return False
+
+    def needs_update(self, stored: str) -> bool:
+        return stored.split("$")[1] != str(self.iterations)
+
+
+class CredentialEngine:
+    """
+    Hashes and verifies passwords in a bounded pool of OS threads, so bursts of logins take at most workers cores
+    and don't starve threads serving agents. New hashes use the first hasher, others are only verified
+    """
+
+    def __init__(self, hashers: list = None, workers: int = 2, queue_size: int = 0):
+        """
+        :param hashers: Hashers, PBKDF2Hasher and Sha256Hasher by default
+        :param workers: Count of threads hashing passwords
+        :param queue_size: Max count of requests waiting for a worker, others are rejected.
+            Waiting requests hold server threads, so keep it a small part of them
+        """
+
+        self.hashers = hashers if hashers is not None else [PBKDF2Hasher(), Sha256Hasher()]
+        self.workers = workers
+        self.slots = BoundedSemaphore(workers + queue_size)
+
+        # Created on the first use, after gevent has patched the worker process
+        self.run = None
+        self.run_lock = Lock()
+
+    def find_hasher(self, stored: str) -> Union[Hasher, None]:
+        for hasher in self.hashers:
+            if hasher.identify(stored):
+                return hasher
+
+    def create_runner(self) -> Callable:
+        """
+        Greenlets of ThreadPoolExecutor under gevent would block the event loop while hashing,
+        so gevent's pool of real OS threads is used there
+
+        :return: Function running fn(*args) in a worker and waiting for its result
+        """
+
+        if gevent_patched():
+            from gevent.threadpool import ThreadPool
+
+            pool = ThreadPool(self.workers)
+            return lambda fn, *args: pool.spawn(fn, *args).get()
+
+        pool = ThreadPoolExecutor(self.workers, thread_name_prefix="credentials")
+        return lambda fn, *args: pool.submit(fn, *args).result()
+
+    def submit(self, fn: Callable, *args):
+        """
+        Run fn(*args) in a worker
+
+        :return: Result of fn or None, if all workers are busy and queue is full
+        """
+
+        if not self.slots.acquire(blocking=False):
+            return None
+
+        try:
+            if self.run is None:
+                with self.run_lock:
+                    if self.run is None:
+                        self.run = self.create_runner()
+
+            return self.run(fn, *args)
+        finally:
+            self.slots.release()
+
+    def hash(self, password: str) -> Union[str, None]:
+        """
+        Hash password with the first hasher
+
+        :return: Hash or None, if too many passwords are hashed already
+        """
+
+        return self.submit(self.hashers[0].hash, password)
+
+    def verify(self, password: str, stored: str) -> Union[bool, None]:
+        """
+        :return: True if password matches stored hash, None if too many passwords are hashed already
+        """
+
+        hasher = self.find_hasher(stored)
+        if hasher is None:
+            return False
+
+        return self.submit(hasher.verify, password, stored)
+
+    def needs_update(self, stored: str) -> bool:
+        """
+        :return: True if stored hash is made by other hasher or with other settings
+        """
+
+        hasher = self.find_hasher(stored)
+        return hasher is not self.hashers[0] or hasher.needs_update(stored)
@@ -1,91 +1,221 @@
 import sqlite3
 
+import os
+import secrets
+
+from contextlib import contextmanager
 from hashlib import sha256
-from random import choice
+from queue import LifoQueue, Empty, Full
 from typing import Union
 
+from cache import MISSING, users_cache, passwords_cache, hash_keys_cache
+from credentials import CredentialEngine, login_digest
+from logger import Logger
+from metrics import db_query_duration
+
+
+database_logger = Logger("Database")
+
+
+class ConnectionPool:
+    """
+    Pool of open sqlite connections with WAL journaling.
+    Connections are kept open, so sqlite reuses prepared statements between requests
+    """
+
+    def __init__(self, path: str, size: int = 16):
+        """
+        :param path: Path to sqlite database file
+        :param size: Max count of idle connections kept open
+        """
+
+        # Absolute, so connections opened later don't depend on working directory
+        self.path = os.path.abspath(path)
+        self.name = os.path.basename(path)
+        self.pool = LifoQueue(size)
+
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False, cached_statements=64)
+
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+
+        return db
+
+    @contextmanager
+    def connection(self, query: str = "") -> sqlite3.Connection:
+        """
+        Take connection from pool (or open new one) and commit transaction on exit
+
+        :param query: Name of query for metrics
+        """
+
+        try:
+            db = self.pool.get_nowait()
+        except Empty:
+            db = self.connect()
+
+        try:
+            with db_query_duration.time(db=self.name, query=query), db:
+                yield db
+        finally:
+            try:
+                self.pool.put_nowait(db)
+            except Full:
+                db.close()
+
 
 class Database:
 
-    def __init__(self):
+    def __init__(self, path: str = "database.db", pool_size: int = 16, credentials: CredentialEngine = None):
+        """
+        :param path: Path to sqlite database file
+        :param pool_size: Max count of idle connections kept open
+        :param credentials: Engine of password hashing, created with default settings if not passed
+        """
+
+        self.pool = ConnectionPool(path, pool_size)
+        self.credentials = credentials if credentials is not None else CredentialEngine()
+        self.connection = self.pool.connection
 
         self.user_count = 0
-        self.user_hash_cache = {}
 
-        with sqlite3.connect("database.db") as db:
+        with self.connection() as db:
             sql = db.cursor()
 
-            sql.execute("CREATE TABLE IF NOT EXISTS users (login, password, id INT, hash_key)")
+            sql.execute("CREATE TABLE IF NOT EXISTS users (login TEXT PRIMARY KEY, password TEXT, id INT, hash_key TEXT)")
+            # Tables created by old versions have no primary key and could get the same login twice.
+            # Old versions used the first row of login, others are removed before creating the index
+            sql.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='users_login'")
 
-        with sqlite3.connect("database.db") as db:
-            sql = db.cursor()
+            if sql.fetchone() is None:
+                sql.execute("DELETE FROM users WHERE rowid NOT IN (SELECT MIN(rowid) FROM users GROUP BY login)")
+                if sql.rowcount:
+                    database_logger.log(f"Removed {sql.rowcount} duplicate rows of users before creating unique index")
+
+                sql.execute("CREATE UNIQUE INDEX users_login ON users (login)")
+
+            # Keys of old versions were sha256 of one of few letters and could be guessed, they are replaced
+            weak_keys = [sha256(sym.encode()).hexdigest() for sym in set("kadvfiuawvfakt4jm")]
+            sql.execute(f"SELECT login FROM users WHERE hash_key IN ({', '.join('?' * len(weak_keys))})", weak_keys)
+
+            for login, in sql.fetchall():
+                sql.execute("UPDATE users SET hash_key=? WHERE login=?", (secrets.token_hex(32), login))
 
             sql.execute("SELECT COUNT(*) FROM users")
             self.user_count = sql.fetchone()[0]
 
-    @staticmethod
-    def is_user(login):
-        login = sha256(login.encode()).hexdigest()
+    def is_user(self, login):
+        is_user = users_cache.get(login)
+        if is_user is not MISSING:
+            return is_user
 
-        with sqlite3.connect("database.db") as db:
+        with self.connection("is_user") as db:
             sql = db.cursor()
 
-            sql.execute("SELECT * FROM users WHERE login=?", (login,))
+            sql.execute("SELECT 1 FROM users WHERE login=?", (login_digest(login),))
+            is_user = sql.fetchone() is not None
 
-            if sql.fetchone() is not None:
-                return True
+        users_cache.set(login, is_user)
 
-            return False
+        return is_user
 
     def create_hash_key(self, user_name: str):
-        with sqlite3.connect("database.db") as db:
+        with self.connection("create_hash_key") as db:
             sql = db.cursor()
-            hash_key = sha256(choice("kadvfiuawvfakt4jm").encode()).hexdigest()
+            hash_key = secrets.token_hex(32)
 
-            sql.execute("UPDATE users SET hash_key=? WHERE login=?", (hash_key, sha256(user_name.encode()).hexdigest(),))
+            sql.execute("UPDATE users SET hash_key=? WHERE login=?", (hash_key, login_digest(user_name),))
 
-            self.user_hash_cache[user_name] = hash_key
+        hash_keys_cache.invalidate(user_name)
 
     def get_hash_key(self, user_name: str) -> Union[str, None]:
-        if user_name in self.user_hash_cache:
-            return self.user_hash_cache[user_name]
+        hash_key = hash_keys_cache.get(user_name)
+        if hash_key is not MISSING:
+            return hash_key
 
-        with sqlite3.connect("database.db") as db:
+        with self.connection("get_hash_key") as db:
             sql = db.cursor()
 
-            sql.execute("SELECT hash_key FROM users WHERE login=?", (sha256(user_name.encode()).hexdigest(),))
-            hash_key = sql.fetchone()[0]
+            sql.execute("SELECT hash_key FROM users WHERE login=?", (login_digest(user_name),))
+            user = sql.fetchone()
 
-            if hash_key != "":
-                return hash_key
-            else:
-                return None
+        hash_key = user[0] if user is not None and user[0] else None
+        hash_keys_cache.set(user_name, hash_key)
 
-    @staticmethod
-    def check_user(login, password):
-        login, password = sha256(login.encode()).hexdigest(), sha256(password.encode()).hexdigest()
-        with sqlite3.connect("database.db") as db:
-            sql = db.cursor()
+        return hash_key
 
-            sql.execute("SELECT * FROM users WHERE login=?", (login,))
+    def check_user(self, login, password) -> Union[bool, None]:
+        """
+        Verify password, old sha256 hash of password is replaced with the current one after successful login
 
-            user = sql.fetchone()
-            print(login)
-            if user is None or user[1] != password:
-                return False
+        :return: True if password is right, None if server verifies too many passwords now
+        """
+
+        user_password = passwords_cache.get(login)
+
+        if user_password is MISSING:
+            with self.connection("check_user") as db:
+                sql = db.cursor()
+
+                sql.execute("SELECT password FROM users WHERE login=?", (login_digest(login),))
+                user = sql.fetchone()
+
+            user_password = user[0] if user is not None else None
+            passwords_cache.set(login, user_password)
+
+        if user_password is None:
+            return False
+
+        verified = self.credentials.verify(password, user_password)
+
+        if verified and self.credentials.needs_update(user_password):
+            password_hash = self.credentials.hash(password)
+
+            # Workers are busy, hash is updated on the next login
+            if password_hash is not None:
+                self.update_password(login, user_password, password_hash)
 
-            return True
+        return verified
 
-    def new_user(self, login, password):
-        with sqlite3.connect("database.db") as db:
+    def update_password(self, login, old_password_hash: str, password_hash: str):
+        """
+        Replace password hash, if it wasn't changed by other request
+        """
+
+        with self.connection("update_password") as db:
             sql = db.cursor()
 
-            if self.is_user(login):
-                return False
-            login, password = sha256(login.encode()).hexdigest(), sha256(password.encode()).hexdigest()
-            print(login)
-            sql.execute("INSERT INTO users VALUES (?, ?, ?, '')", (login, password, self.user_count))
+            sql.execute("UPDATE users SET password=? WHERE login=? AND password=?",
+                        (password_hash, login_digest(login), old_password_hash))
+
+        passwords_cache.invalidate(login)
+
+    def new_user(self, login, password) -> Union[bool, None]:
+        """
+        :return: True if user is created, False if login is taken, None if server hashes too many passwords now
+        """
+
+        if self.is_user(login):
+            return False
+
+        login_hash, password_hash = login_digest(login), self.credentials.hash(password)
+
+        if password_hash is None:
+            return None
+
+        try:
+            with self.connection("new_user") as db:
+                sql = db.cursor()
+
+                sql.execute("INSERT INTO users VALUES (?, ?, ?, '')", (login_hash, password_hash, self.user_count))
+        except sqlite3.IntegrityError:
+            return False
+        finally:
+            users_cache.invalidate(login)
+            passwords_cache.invalidate(login)
+            hash_keys_cache.invalidate(login)
 
-            self.user_count += 1
+        self.user_count += 1
 
-            return True
+        return True
@@ -0,0 +1,16 @@
+# Production server config, used by "python3 main.py" and "gunicorn -c gunicorn.conf.py 'main:create_app()'"
+# All values are taken from config.json
+
+from config import load_config
+
+
+server_config = load_config()
+
+bind = f"{server_config['ip'] or '0.0.0.0'}:{server_config['port']}"
+
+workers = server_config["workers"]
+threads = server_config["threads"]
+worker_class = server_config["worker_class"]
+
+keepalive = server_config["keepalive"]
+timeout = server_config["timeout"]
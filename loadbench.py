@@ -0,0 +1,394 @@
+"""
+Load benchmark: starts the server in a temporary directory and simulates agents, that register buttons
+and receive clicks, while "users" click buttons through /computers/<id>/button_click.
+
+Modes:
+    poll       agents ask /a for actions every --interval seconds
+    long-poll  agents wait for actions in /a with "wait"
+    push       agents are connected to /ws
+
+Server identifies computers by remote address, so every agent uses its own loopback address 127.1.x.y (Linux only).
+
+Examples:
+    python3 loadbench.py --agents 500 --mode poll push
+    python3 loadbench.py --agents 200 --users 4 --clicks 50 --duration 30 --mode long-poll --output result.json
+"""
+
+import argparse
+import http.client
+import io
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import deque
+from contextlib import redirect_stdout
+from threading import Thread, Event, Lock
+from urllib.parse import urlsplit
+
+import requests
+import simple_websocket
+
+from wsproto import ConnectionType
+
+
+root_dir = os.path.dirname(os.path.abspath(__file__))
+
+user_password = "benchmark"
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)]
+
+
+def latency_summary(values: list) -> dict:
+    """
+    :return: Count, p50 and p99 in milliseconds
+    """
+
+    return {"count": len(values), "p50_ms": round(percentile(values, 0.5) * 1000, 3),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 3)}
+
+
+def rss(pid: int) -> int:
+    """
+    :return: Resident memory of process and its children in bytes
+    """
+
+    total = 0
+
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1]) * 1024
+
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            children = file.read().split()
+    except FileNotFoundError:
+        return total
+
+    return total + sum(rss(int(child)) for child in children)
+
+
+class Server:
+    """
+    Server in gunicorn with its own config, database and logs in a temporary directory
+    """
+
+    def __init__(self, port: int, threads: int, users: list, state_backend: str = "memory"):
+        self.url = f"http://127.0.0.1:{port}"
+        self.dir = tempfile.mkdtemp(prefix="pc_controller_bench_")
+
+        with open(os.path.join(self.dir, "config.json"), "w") as file:
+            json.dump({"ip": "127.0.0.1", "port": port, "threads": threads, "state_backend": state_backend,
+                       "state_path": os.path.join(self.dir, "state.db")}, file)
+
+        sys.path.insert(0, root_dir)
+        from database import Database
+
+        database = Database(os.path.join(self.dir, "database.db"))
+        with redirect_stdout(io.StringIO()):
+            for user_name in users:
+                database.new_user(user_name, user_password)
+
+        self.process = subprocess.Popen(
+            ["gunicorn", "-c", os.path.join(root_dir, "gunicorn.conf.py"), "main:create_app()"], cwd=self.dir,
+            env=dict(os.environ, PYTHONPATH=root_dir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        self.wait_ready()
+
+    def wait_ready(self, timeout: float = 20):
+        end_time = time.time() + timeout
+
+        while time.time() < end_time:
+            try:
+                requests.get(self.url + "/docs", timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+
+        self.stop()
+        raise RuntimeError("Server was not started")
+
+    def memory(self) -> int:
+        return rss(self.process.pid)
+
+    def stop(self):
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class AgentSocket(simple_websocket.Client):
+    """
+    WebSocket client, that connects from the given local address.
+    simple_websocket.Client can't bind local address, so its __init__ is replaced: attributes are set as in
+    simple-websocket 1.1.0 (pinned in requirements.txt with wsproto), check them after upgrade
+    """
+
+    def __init__(self, url: str, source: str):
+        parsed_url = urlsplit(url)
+
+        self.host = parsed_url.hostname
+        self.port = parsed_url.port
+        self.path = parsed_url.path
+        self.subprotocols = []
+        self.extra_headeers = []
+
+        sock = socket.create_connection((self.host, self.port), source_address=(source, 0))
+        simple_websocket.ws.Base.__init__(self, sock, connection_type=ConnectionType.CLIENT)
+
+
+class Stats:
+    def __init__(self):
+        self.lock = Lock()
+
+        self.requests = 0
+        self.errors = 0
+        self.latencies = []
+        self.delivery = []
+
+    def request(self, latency: float):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(latency)
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+
+class Agent:
+    def __init__(self, index: int, user_name: str, server: Server, stats: Stats, stop_event: Event):
+        self.index = index
+        self.user_name = user_name
+        self.name = f"agent{index}"
+        self.address = f"127.1.{index // 250}.{index % 250 + 1}"
+
+        self.server = server
+        self.stats = stats
+        self.stop_event = stop_event
+
+        # Times of clicks, that were sent to this agent but not received yet
+        self.clicks = deque()
+        self.connection = None
+
+    def request(self, data: dict, timeout: float = 30) -> list:
+        if self.connection is None:
+            host, port = urlsplit(self.server.url).netloc.split(":")
+            self.connection = http.client.HTTPConnection(host, int(port), timeout=timeout,
+                                                         source_address=(self.address, 0))
+
+        data = dict(data, user_name=self.user_name)
+        start_time = time.perf_counter()
+
+        try:
+            # /a expects json string with json object inside
+            self.connection.request("POST", "/a", json.dumps(json.dumps(data)), {"Content-Type": "application/json"})
+            answer = json.loads(self.connection.getresponse().read())
+        except (OSError, http.client.HTTPException, ValueError):
+            self.stats.error()
+            self.connection.close()
+            self.connection = None
+            return []
+
+        self.stats.request(time.perf_counter() - start_time)
+
+        return answer["actions"]
+
+    def register(self):
+        # "name" is also an argument of actions, so computer name is sent in a separate request
+        self.request({"name": self.name})
+        self.request({"action": "method", "type": "button.add", "name": "button", "text": "Button"})
+
+    def received(self, actions: list):
+        now = time.perf_counter()
+
+        for action in actions:
+            if action.get("type") != "button.click":
+                continue
+
+            with self.stats.lock:
+                for _ in range(action.get("count", 1)):
+                    if self.clicks:
+                        self.stats.delivery.append(now - self.clicks.popleft())
+
+    def run_poll(self, interval: float):
+        # Spread requests of agents over the interval
+        self.stop_event.wait(random.random() * interval)
+
+        while not self.stop_event.is_set():
+            self.received(self.request({"get_actions": True}))
+            self.stop_event.wait(interval)
+
+    def run_long_poll(self, wait: float):
+        while not self.stop_event.is_set():
+            self.received(self.request({"get_actions": True, "wait": wait}, timeout=wait + 30))
+
+    def run_push(self):
+        ws = AgentSocket(self.server.url.replace("http", "ws") + "/ws", self.address)
+
+        try:
+            ws.send(json.dumps({"user_name": self.user_name, "name": self.name}))
+
+            while not self.stop_event.is_set():
+                message = ws.receive(timeout=0.5)
+                if message:
+                    self.received(json.loads(message)["actions"])
+        except simple_websocket.ConnectionClosed:
+            self.stats.error()
+        finally:
+            ws.close()
+
+
+class Clicker:
+    """
+    Clicks buttons of random agents through the site, as users do
+    """
+
+    def __init__(self, server: Server, agents: list, rate: float, stop_event: Event):
+        self.server = server
+        self.rate = rate
+        self.stop_event = stop_event
+
+        self.sessions = {}
+        # (user name, computer id) -> agent, ids are known because agents of each user register in order
+        self.agents = {}
+        self.latencies = []
+
+        for agent in agents:
+            if agent.user_name not in self.sessions:
+                session = requests.Session()
+                session.post(server.url + "/login", data={"login": agent.user_name, "password": user_password})
+                self.sessions[agent.user_name] = session
+
+            self.agents[(agent.user_name, sum(1 for key in self.agents if key[0] == agent.user_name) + 1)] = agent
+
+    def run(self):
+        keys = list(self.agents)
+
+        while not self.stop_event.wait(1 / self.rate):
+            user_name, _id = random.choice(keys)
+            agent = self.agents[(user_name, _id)]
+
+            with agent.stats.lock:
+                agent.clicks.append(time.perf_counter())
+
+            start_time = time.perf_counter()
+            self.sessions[user_name].get(f"{self.server.url}/computers/{_id}/button_click/button",
+                                         allow_redirects=False)
+            self.latencies.append(time.perf_counter() - start_time)
+
+
+def run_mode(mode: str, args) -> dict:
+    users = [f"bench{i}" for i in range(args.users)]
+
+    # Every websocket and long poll request holds a server thread
+    server = Server(args.port, args.agents + 50, users, args.state_backend)
+
+    try:
+        stats = Stats()
+        stop_event = Event()
+        agents = [Agent(i, users[i % len(users)], server, stats, stop_event) for i in range(args.agents)]
+
+        memory_before = server.memory()
+
+        for agent in agents:
+            agent.register()
+
+        # Registration requests are not counted
+        stats = Stats()
+        for agent in agents:
+            agent.stats = stats
+
+        if mode == "poll":
+            threads = [Thread(target=agent.run_poll, args=(args.interval,)) for agent in agents]
+        elif mode == "long-poll":
+            threads = [Thread(target=agent.run_long_poll, args=(args.wait,)) for agent in agents]
+        else:
+            threads = [Thread(target=agent.run_push) for agent in agents]
+
+        for thread in threads:
+            thread.start()
+
+        # Let agents connect before measuring memory
+        time.sleep(min(2, args.duration / 4))
+        memory_after = server.memory()
+
+        clicker = Clicker(server, agents, args.clicks, stop_event)
+        clicker_thread = Thread(target=clicker.run)
+
+        start_time = time.perf_counter()
+        start_requests = stats.requests
+        clicker_thread.start()
+
+        time.sleep(args.duration)
+
+        duration = time.perf_counter() - start_time
+        requests_count = stats.requests - start_requests
+
+        stop_event.set()
+        clicker_thread.join()
+        for thread in threads:
+            thread.join(args.wait + 5)
+
+        return {
+            "mode": mode,
+            "agents": args.agents,
+            "duration": round(duration, 3),
+            "requests_per_sec": round(requests_count / duration, 1),
+            "errors": stats.errors,
+            "request_latency": latency_summary(stats.latencies),
+            "click_latency": latency_summary(clicker.latencies),
+            "click_to_delivery": dict(latency_summary(stats.delivery),
+                                      undelivered=sum(len(agent.clicks) for agent in agents)),
+            "memory_per_computer": round((memory_after - memory_before) / args.agents)
+        }
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark with simulated agents")
+    parser.add_argument("--mode", nargs="+", choices=["poll", "long-poll", "push"], default=["poll", "push"])
+    parser.add_argument("--agents", type=int, default=200)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=20, help="Seconds of measurement for each mode")
+    parser.add_argument("--interval", type=float, default=1, help="Poll interval in seconds")
+    parser.add_argument("--wait", type=float, default=15, help="Long poll wait in seconds")
+    parser.add_argument("--clicks", type=float, default=20, help="Clicks per second")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--state-backend", default="memory")
+    parser.add_argument("--output", help="Write results to json file")
+    args = parser.parse_args()
+
+    # Agents connect from 127.1.x.y, other systems route only 127.0.0.1 on loopback
+    if not sys.platform.startswith("linux"):
+        parser.error("loadbench.py works on Linux only")
+
+    results = [run_mode(mode, args) for mode in args.mode]
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4)
+
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,201 @@
+import atexit
+import gzip
+import json
 import os
+import shutil
 import time
 
-from threading import Thread
-from time import sleep
+from contextlib import contextmanager
+from queue import SimpleQueue, Empty
+from threading import Thread, RLock
 
+try:
+    import fcntl
+except ImportError:
+    # Windows: one process writes logs, files are not locked
+    fcntl = None
 
-class GlobalLogger:
-    def __init__(self):
-        self.max_size = 100
-        self.logs_count = 0
-        self.stack = []
-
-        if not os.path.isdir("logs"):
-            os.mkdir("logs")
-
-        if not os.path.isfile("logs/logs.log"):
-            open("logs.log", "w").close()
 
-        for file in os.listdir("logs"):
-            if file.startswith("oldlog_"):
-                self.logs_count += 1
+class GlobalLogger:
+    """
+    Batched log writer, safe for several processes (gunicorn workers) writing the same file.
+    Logs are written under a shared lock of <path>.lock and rotated under an exclusive one,
+    writers reopen the file after other process has rotated it
+    """
+
+    def __init__(self, path: str = "logs/logs.log", max_size: int = 10 * 1024 * 1024, compress: bool = True,
+                 flush_size: int = 64 * 1024, flush_interval: float = 0.5, old_prefix: str = "oldlogs_"):
+        """
+        :param path: Path to log file
+        :param max_size: Max size of log file in bytes, after that it is rotated to <old_prefix><n>
+        :param compress: Compress rotated files with gzip
+        :param flush_size: Flush file after so many bytes were written
+        :param flush_interval: Max time in seconds before written logs are flushed
+        :param old_prefix: Name prefix of rotated files
+        """
+
+        # Absolute, so working directory can be changed after start
+        self.path = os.path.abspath(path)
+        self.dir = os.path.dirname(self.path)
+        self.max_size = max_size
+        self.compress = compress
+        self.old_prefix = old_prefix
+
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self.queue = SimpleQueue()
+        self.lock = RLock()
+
+        # Logs are kept in memory until flush, so they are never written to a file rotated by other process
+        self.buffer = []
+        self.not_flushed = 0
+
+        os.makedirs(self.dir, exist_ok=True)
+
+        self.lock_file = open(self.path + ".lock", "ab")
+        self.file = open(self.path, "ab")
 
     def add_log_info(self, info: str):
-        self.stack.append(info)
+        self.queue.put(info)
 
     def set_max_size(self, size: int):
         self.max_size = size
 
     def run(self):
-        cur_str = 0
-
         while True:
-            sleep(0.1)
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except Empty:
+                self.flush()
+                continue
+
+            self.write(batch)
+
+    def write(self, batch: list):
+        """
+        Write batch and all logs from queue to buffer, buffer is flushed after flush_size bytes
+        """
+
+        try:
+            while len(batch) < 10000:
+                batch.append(self.queue.get_nowait())
+        except Empty:
+            pass
+
+        data = "".join(batch).encode()
+
+        with self.lock:
+            self.buffer.append(data)
+            self.not_flushed += len(data)
+
+            if self.not_flushed >= self.flush_size:
+                self.flush()
+
+    @contextmanager
+    def file_lock(self, exclusive: bool):
+        """
+        Lock log file for all processes
+        """
+
+        if fcntl is None:
+            yield
+            return
+
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    def reopen_rotated(self):
+        """
+        Reopen file, if it was rotated by other process. Called under file lock
+        """
+
+        try:
+            rotated = os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+        except FileNotFoundError:
+            rotated = True
+
+        if rotated:
+            self.file.close()
+            self.file = open(self.path, "ab")
+
+    def flush(self):
+        with self.lock:
+            if not self.buffer:
+                return
 
-            with open("logs/logs.log", "a") as file:
-                while len(self.stack):
-                    log_info = self.stack.pop(0)
+            with self.file_lock(exclusive=False):
+                self.reopen_rotated()
 
-                    file.write(log_info)
+                self.file.write(b"".join(self.buffer))
+                self.file.flush()
+                size = self.file.tell()
 
-                    cur_str += 1
+            self.buffer = []
+            self.not_flushed = 0
 
-                    if cur_str > self.max_size:
-                        break
+            if size >= self.max_size:
+                self.rotate()
 
-            if cur_str > self.max_size:
-                os.rename("logs/logs.log", f"logs/oldlogs_{self.logs_count}")
+    def next_old_path(self) -> str:
+        """
+        :return: Path of the next rotated file, numbers are taken from directory, so processes don't reuse them
+        """
 
-                self.logs_count += 1
-                cur_str = 0
+        numbers = [-1]
+
+        for file in os.listdir(self.dir):
+            if file.startswith(self.old_prefix):
+                number = file[len(self.old_prefix):].split(".")[0]
+
+                if number.isdigit():
+                    numbers.append(int(number))
+
+        return os.path.join(self.dir, f"{self.old_prefix}{max(numbers) + 1}")
+
+    def rotate(self):
+        old_path = None
+
+        with self.lock, self.file_lock(exclusive=True):
+            self.reopen_rotated()
+
+            # Other process could rotate file before this one got the lock
+            if os.fstat(self.file.fileno()).st_size >= self.max_size:
+                old_path = self.next_old_path()
+                os.rename(self.path, old_path)
+
+                self.file.close()
+                self.file = open(self.path, "ab")
+
+        if old_path is not None and self.compress:
+            Thread(target=self.compress_file, args=(old_path,), daemon=True).start()
+
+    @staticmethod
+    def compress_file(path: str):
+        with open(path, "rb") as file, gzip.open(path + ".gz", "wb") as gz_file:
+            shutil.copyfileobj(file, gz_file)
+        os.remove(path)
+
+    def close(self):
+        """
+        Write all logs from queue, called at exit
+        """
+
+        self.write([])
+        self.flush()
 
 
 global_logger = GlobalLogger()
 Thread(daemon=True, target=global_logger.run).start()
+atexit.register(global_logger.close)
+
+# Structured events, one json object per line. Use logquery.py to search them
+events_logger = GlobalLogger("logs/events.jsonl", old_prefix="oldevents_")
+Thread(daemon=True, target=events_logger.run).start()
+atexit.register(events_logger.close)
 
 
 class Logger:
@@ -60,13 +203,35 @@ class Logger:
     def __init__(self, logger_name="Unknown"):
         self.logger_name = logger_name
         self.global_logger = global_logger
+        self.events_logger = events_logger
 
     def log(self, *args, name=None):
         if name is None:
             name = self.logger_name
 
-        s = ""
-        for _s in args:
-            s += str(_s)
+        s = "".join(map(str, args))
 
         self.global_logger.add_log_info(f"{time.strftime('%D %T')} {name}: {s}\n")
+
+    def event(self, action_type: str, user: str = None, computer: int = None, latency: float = None, **kwargs):
+        """
+        Write structured event to events log
+
+        :param action_type: Type of event, e.g. "button.click"
+        :param user: User name
+        :param computer: Computer id
+        :param latency: Duration in seconds
+        :param kwargs: Other fields
+        """
+
+        event = {"ts": round(time.time(), 3), "logger": self.logger_name, "type": action_type}
+
+        if user is not None:
+            event["user"] = user
+        if computer is not None:
+            event["computer"] = computer
+        if latency is not None:
+            event["latency"] = round(latency, 6)
+        event.update(kwargs)
+
+        self.events_logger.add_log_info(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n")
@@ -0,0 +1,173 @@
+"""
+Search and aggregate structured events from logs/events.jsonl and its rotated files.
+Files are read line by line, so memory doesn't depend on logs size.
+
+Examples:
+    python3 logquery.py --user login --computer 7 --type button.click --since 1h
+    python3 logquery.py --type computer.request --group-by user --latency
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import math
+import os
+import sys
+import time
+
+from collections import Counter
+from typing import Iterator, Union
+
+
+time_units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_time(value: str) -> float:
+    """
+    :param value: Unix time or time ago: "30s", "15m", "1h", "2d"
+    :return: Unix time
+    """
+
+    if value[-1] in time_units:
+        return time.time() - float(value[:-1]) * time_units[value[-1]]
+    return float(value)
+
+
+def log_files(logs_dir: str = "logs") -> list:
+    """
+    :return: Rotated event files from the oldest one and the current file
+    """
+
+    def number(path):
+        name = os.path.basename(path)[len("oldevents_"):]
+        return int(name.split(".")[0])
+
+    files = sorted(glob.glob(os.path.join(logs_dir, "oldevents_*")), key=number)
+    current = os.path.join(logs_dir, "events.jsonl")
+
+    if os.path.isfile(current):
+        files.append(current)
+
+    return files
+
+
+def read_events(files: list) -> Iterator[dict]:
+    for path in files:
+        opener = gzip.open if path.endswith(".gz") else open
+
+        with opener(path, "rt", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+class LatencyStats:
+    """
+    Latency summary in constant memory, percentiles are approximated by log-scale buckets (~5% error)
+    """
+
+    base = 1.05
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = math.inf
+        self.max = 0
+        self.buckets = Counter()
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.buckets[math.floor(math.log(max(value, 1e-6), self.base))] += 1
+
+    def percentile(self, p: float) -> float:
+        rank = p * self.count
+        seen = 0
+
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.base ** (bucket + 1), self.max)
+
+        return self.max
+
+    def to_dict(self) -> dict:
+        if not self.count:
+            return {"count": 0}
+
+        return {"count": self.count, "mean": self.sum / self.count, "min": self.min, "max": self.max,
+                "p50": self.percentile(0.5), "p99": self.percentile(0.99)}
+
+
+def match(event: dict, args) -> bool:
+    if args.user is not None and event.get("user") != args.user:
+        return False
+    if args.computer is not None and event.get("computer") != args.computer:
+        return False
+    if args.type is not None and event.get("type") != args.type:
+        return False
+    if args.since is not None and event.get("ts", 0) < args.since:
+        return False
+    if args.until is not None and event.get("ts", 0) > args.until:
+        return False
+
+    return True
+
+
+def group_key(event: dict, group_by: str) -> Union[str, int, None]:
+    if group_by == "hour":
+        return time.strftime("%Y-%m-%d %H:00", time.localtime(event.get("ts", 0)))
+    return event.get(group_by)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query structured events log")
+    parser.add_argument("files", nargs="*", help="Event files, by default all files in --logs-dir")
+    parser.add_argument("--logs-dir", default="logs")
+    parser.add_argument("--user")
+    parser.add_argument("--computer", type=int)
+    parser.add_argument("--type", help="Event type, e.g. button.click")
+    parser.add_argument("--since", type=parse_time, help="Unix time or time ago: 30m, 1h, 2d")
+    parser.add_argument("--until", type=parse_time)
+    parser.add_argument("--group-by", help="Event field or 'hour'")
+    parser.add_argument("--latency", action="store_true", help="Show latency stats")
+    parser.add_argument("--print", action="store_true", help="Print matched events")
+    args = parser.parse_args()
+
+    files = args.files or log_files(args.logs_dir)
+    total = 0
+    groups = Counter()
+    latency = {}
+
+    for event in read_events(files):
+        if not match(event, args):
+            continue
+
+        total += 1
+        key = group_key(event, args.group_by) if args.group_by else None
+
+        if args.group_by:
+            groups[key] += 1
+        if args.latency and "latency" in event:
+            latency.setdefault(key, LatencyStats()).add(event["latency"])
+        if args.print:
+            sys.stdout.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    result = {"files": len(files), "count": total}
+
+    if args.group_by:
+        result["groups"] = {str(key): count for key, count in groups.most_common()}
+    if args.latency:
+        result["latency"] = {str(key): stats.to_dict() for key, stats in latency.items()} if args.group_by \
+            else latency.get(None, LatencyStats()).to_dict()
+
+    print(json.dumps(result, ensure_ascii=False, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,102 @@
+import argparse
 import flask
 import functools
 import json
+import math
+import os
 
-from flask import Flask, render_template, redirect, jsonify
-from socket import gethostbyname_ex, gethostname
+from flask import Flask, Response, render_template, redirect, jsonify
+from flask_sock import Sock, ConnectionClosed
+from threading import Lock
+from time import perf_counter
 
+from backend import create_backend
+from cache import users_cache, passwords_cache, hash_keys_cache
 from computer import *
+from config import load_config
+from credentials import CredentialEngine, PBKDF2Hasher, Sha256Hasher
 from database import Database
-from logger import Logger
+from logger import Logger, global_logger, events_logger
+from metrics import registry, request_duration
+from ratelimit import create_limiter
+from tokens import TokenSigner
 
 
-try:
-    with open('config.json') as file:
-        config = json.load(file)
-except:
-    with open('config.json', 'w') as file:
-        file.write('{"ip": ""}')
-    print(f"You can try address: {gethostbyname_ex(gethostname())[-1][0]}")
-
+config = load_config()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = "skzhef3720t92497tyasojgke4892035ui"
 
-app_ip = config["ip"]  #
+sock = Sock(app)
 
-debug = True
+app_ip = config["ip"]  #
+app_port = config["port"]
 
-database = Database()
+# Requests waiting for password workers hold server threads, at most a tenth of them may wait
+database = Database(credentials=CredentialEngine([PBKDF2Hasher(config["password_iterations"]), Sha256Hasher()],
+                                                  config["password_workers"], config["threads"] // 10))
 main_logger = Logger("Main")
-comp_handler = ComputerHandler(True)
+# Tokens must be verified by all processes, so secret is taken from config or from the app secret key
+tokens = TokenSigner(config["token_secret"] or app.config['SECRET_KEY'], config["token_ttl"])
+comp_handler = ComputerHandler(True, create_backend(config["state_backend"], config["state_path"]),
+                               config["coalesce_clicks"], config["snapshot_path"], config["max_computers"], tokens)
+
+# Limiters are checked before any session, database or registry work, so rejected requests are cheap
+address_limiter = create_limiter("address", config["address_rate_limit"])
+user_limiter = create_limiter("user", config["user_rate_limit"])
+login_limiter = create_limiter("login", config["login_rate_limit"])
+
+socket_heartbeat = 5
+
+registry.gauge("pc_controller_computers", "Computers of this process",
+               lambda: {(key,): value for key, value in comp_handler.stats().items()}, ("state",))
+registry.gauge("pc_controller_pending_clicks", "Clicks not taken by computers yet", comp_handler.backend.pending_clicks)
+registry.gauge("pc_controller_log_queue", "Log lines waiting for writing",
+               lambda: {("logs",): global_logger.queue.qsize(), ("events",): events_logger.queue.qsize()}, ("log",))
+registry.gauge("pc_controller_cache", "User caches stats",
+               lambda: {(name, key): value
+                        for name, cache in (("users", users_cache), ("passwords", passwords_cache),
+                                            ("hash_keys", hash_keys_cache))
+                        for key, value in cache.stats().items()}, ("cache", "stat"))
+
+
+@app.before_request
+def start_request_timer():
+    flask.g.start_time = perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    if "start_time" in flask.g:
+        route = flask.request.url_rule.rule if flask.request.url_rule is not None else "unknown"
+        request_duration.observe(perf_counter() - flask.g.start_time, route=route, method=flask.request.method,
+                                 status=response.status_code)
+
+    return response
+
+
+def check_limit(limiter, key) -> float:
+    """
+    :return: 0 if request is allowed (or limiter is disabled), otherwise seconds to wait before retry
+    """
+
+    return limiter.acquire(key) if limiter is not None else 0
+
+
+def retry_action(retry_after: float) -> dict:
+    return Errors.gen_action(Errors.RATE_LIMITED, retry_after=round(retry_after, 3))
+
+
+def rate_limited(retry_after: float) -> Response:
+    """
+    :return: 429 response with error action in /a answer format
+    """
+
+    response = jsonify({"count": 1, "actions": [retry_action(retry_after)]})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(math.ceil(retry_after))
+
+    return response
 
 
 def check_login(check_user_login=False):
@@ -71,11 +139,28 @@ def login():
 
     login, password = flask.request.form['login'], flask.request.form['password']
 
-    if database.check_user(login, password):
+    # Login limiter is keyed by address too, so nobody can lock out other user by wrong passwords
+    retry_after = check_limit(address_limiter, flask.request.remote_addr) or \
+        check_limit(login_limiter, (flask.request.remote_addr, login))
+    if retry_after:
+        main_logger.event("user.login", user=login, success=False, rate_limited=True)
+        return render_template("login.html", wrong=2, retry_after=math.ceil(retry_after), user_name=None,
+                               none=None), 429
+
+    verified = database.check_user(login, password)
+
+    if verified is None:
+        # All password workers are busy
+        main_logger.event("user.login", user=login, success=False, busy=True)
+        return render_template("login.html", wrong=2, retry_after=1, user_name=None, none=None), 503
+
+    if verified:
         main_logger.log("Logged in with login: ", login)
+        main_logger.event("user.login", user=login, success=True)
         flask.session["login"] = login
         return redirect("/computers")
     else:
+        main_logger.event("user.login", user=login, success=False)
         return render_template("login.html", wrong=1, user_name=None, none=None)
 
 
@@ -131,10 +216,21 @@ def register():
         return render_template("register.html", login_error=login_error, password_error=password_error, user_name=None,
                                none=None)
 
-    else:
-        database.new_user(login, password)
-        flask.session["login"] = login
-        return redirect("/")
+    created = database.new_user(login, password)
+
+    if created is None:
+        # All password workers are busy
+        return render_template("register.html", login_error=4, password_error=0, user_name=None, none=None), 503
+    elif not created:
+        return render_template("register.html", login_error=3, password_error=0, user_name=None, none=None)
+
+    flask.session["login"] = login
+    return redirect("/")
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/docs")
@@ -169,33 +265,195 @@ def create_hash_key():
 @app.route("/computers")
 @check_login(True)
 def computers():
-    user_name = flask.session["login"]
-    return render_template("computers.html", computers=comp_handler.get_user_computers(user_name), user_name=user_name,
-                           port="5000", ip=app_ip, len=len, none=None)
+    # Computers are loaded by the page from /api/computers and updated with deltas
+    return render_template("computers.html", user_name=flask.session["login"], port=app_port, ip=app_ip, none=None)
 
 
-@app.route("/computers/<int:_id>/button_click/<string:button_name>")
+@app.route("/api/computers")
 @check_login()
-def button_click(_id, button_name):
-    user_name = flask.session["login"]
+def api_computers():
+    """
+    Computers of user as json. Query args:
+    since - version from the previous answer, only changes after it are returned,
+    status - "online" or "offline", after and limit - pagination of full listing.
+    If-None-Match only makes 304 answer, if nothing changed, so cached full page is never replaced with delta
+    """
+
+    args = flask.request.args
+
+    since = comp_handler.parse_version_tag(args["since"]) if args.get("since") else None
+    online = {"online": True, "offline": False}.get(args.get("status"))
+    after = args.get("after", 0, type=int)
+    limit = min(max(args.get("limit", 100, type=int), 1), 1000)
+
+    answer = comp_handler.list_computers(flask.session["login"], since, online, after, limit)
+
+    if flask.request.if_none_match.contains(answer["version"]) or \
+            since is not None and not answer["full"] and not answer["computers"] and not answer["removed"]:
+        response = Response(status=304)
+    else:
+        response = jsonify(answer)
+
+    response.headers["ETag"] = f'"{answer["version"]}"'
+    response.headers["Cache-Control"] = "no-cache"
+
+    return response
+
+
+def press_button(user_name, _id, button_name):
+    main_logger.log("Tap button: %s" % button_name, " ", _id, name=user_name)
 
-    main_logger.log("Tap button: %s" % button_name, " ", _id, name=flask.session["login"])
-    
     comp = comp_handler.get_computer(user_name, _id=_id)
 
     if comp is not None:
         comp.press_button(button_name)
     else:
-        main_logger.log("Computer not found!", _id, name=flask.session["login"])
+        main_logger.log("Computer not found!", _id, name=user_name)
+
+    main_logger.event(Methods.BUTTON_CLICK.str_type, user=user_name, computer=_id, button=button_name,
+                      found=comp is not None)
+
+
+def agent_request_errors(data) -> list:
+    """
+    :return: Names of args of agent request, that have wrong types, empty list if request is valid
+    """
+
+    if not isinstance(data, dict):
+        return ["user_name"]
+
+    return [arg for arg in ("user_name", "name") if arg in data and not isinstance(data[arg], str)]
+
+
+def click_request_errors(data) -> list:
+    """
+    :return: Names of missing or wrong args of bulk click request, empty list if request is valid
+    """
+
+    if not isinstance(data, dict):
+        return ["name", "ids"]
+
+    wrong_args = [] if isinstance(data.get("name"), str) else ["name"]
+
+    if "ids" in data:
+        # bool is int too
+        if not isinstance(data["ids"], list) or not all(type(_id) is int for _id in data["ids"]):
+            wrong_args.append("ids")
+        return wrong_args
+
+    select = data.get("select")
+
+    # Empty selector would click all computers, broadcast is for that
+    if not isinstance(select, dict) or not select:
+        return wrong_args + ["select"]
+
+    checks = {"name": lambda value: isinstance(value, str), "adr": lambda value: isinstance(value, str),
+              "status": lambda value: value in ("online", "offline"), "tags": lambda value: is_tags(value) and value}
+
+    wrong_args += [f"select.{key}" for key, value in select.items() if key not in checks or not checks[key](value)]
+
+    return wrong_args
+
+
+@app.route("/api/computers/click", methods=["POST"])
+@check_login()
+def api_click():
+    """
+    Click button of many computers. Json body: {"name": button name, "ids": [computer ids]} or
+    {"name": button name, "select": {"name": glob pattern, "adr": address prefix, "status": "online" or "offline",
+    "tags": [tags]}}
+    """
+
+    user_name = flask.session["login"]
+    data = flask.request.get_json(silent=True)
+
+    wrong_args = click_request_errors(data)
+    if wrong_args:
+        return jsonify({"count": 1, "actions": [Errors.gen_action(Errors.NEED_ARGS, args=wrong_args)]}), 400
+
+    button_name = data["name"]
+
+    if "ids" in data:
+        ids = data["ids"]
+        computers = comp_handler.select_computers(user_name, ids)
+    else:
+        select = data["select"]
+        ids = None
+        computers = comp_handler.select_computers(
+            user_name, name=select.get("name"), adr=select.get("adr"),
+            online={"online": True, "offline": False}.get(select.get("status")), tags=select.get("tags"))
+
+    clicked = {comp.id for comp in comp_handler.press_buttons(user_name, button_name, computers)}
+    found = {comp.id for comp in computers}
+
+    results = [Results.gen_action(Results.OK, id=_id) if _id in clicked else
+               Errors.gen_action(Errors.BUTTON_NOT_FOUND, id=_id) if _id in found else
+               Errors.gen_action(Errors.COMPUTER_NOT_FOUND, id=_id)
+               for _id in (ids if ids is not None else [comp.id for comp in computers])]
+
+    main_logger.event("button.click_many", user=user_name, button=button_name, selected=len(results),
+                      clicked=len(clicked))
+
+    return jsonify({"count": len(results), "actions": results})
+
+
+@app.route("/computers/<int:_id>/button_click/<string:button_name>")
+@check_login()
+def button_click(_id, button_name):
+    press_button(flask.session["login"], _id, button_name)
 
     return redirect("/computers")
 
 
+def socket_sender(ws):
+    """
+    Make thread-safe function, that sends actions to websocket in /a answer format
+    """
+
+    lock = Lock()
+
+    def send(actions):
+        if isinstance(actions, dict):
+            actions = [actions]
+
+        with lock:
+            try:
+                ws.send(json.dumps({"count": len(actions), "actions": actions}))
+            except ConnectionClosed:
+                pass
+
+    return send
+
+
+@sock.route("/computers/ws")
+@check_login()
+def computers_socket(ws):
+    user_name = flask.session["login"]
+    send = socket_sender(ws)
+
+    comp_handler.subscribe(user_name, send)
+
+    try:
+        while True:
+            data = json.loads(ws.receive())
+
+            if data.get("action") == Methods.action and Methods.BUTTON_CLICK == data.get("type"):
+                press_button(user_name, data.get("id"), data.get("name"))
+    finally:
+        comp_handler.unsubscribe(user_name, send)
+
+
 @app.route("/a", methods=["POST", "GET"])
 def comp_connect():
     if flask.request.method == "GET":
         return "Only for computer connection!"
 
+    start_time = perf_counter()
+
+    retry_after = check_limit(address_limiter, flask.request.remote_addr)
+    if retry_after:
+        return rate_limited(retry_after)
+
     data = flask.request.get_json()
 
     if data is None:
@@ -203,16 +461,27 @@ def comp_connect():
     else:
         data = json.loads(data)
 
-    print(data, type(data))
+    wrong_args = agent_request_errors(data)
+    if wrong_args:
+        return jsonify({"count": 1, "actions": [Errors.gen_action(Errors.NEED_ARGS, args=wrong_args)]})
+
+    if "token" in data:
+        return token_request(data, start_time)
 
     if "user_name" in data:
         user_name = data["user_name"]
-        flask.session["user_name"] = user_name
     elif "user_name" in flask.session:
         user_name = flask.session["user_name"]
     else:
         return jsonify({"count": 1, "actions": [Errors.gen_action(Errors.NEED_ARGS)]})
 
+    retry_after = check_limit(user_limiter, user_name)
+    if retry_after:
+        return rate_limited(retry_after)
+
+    if "user_name" in data:
+        flask.session["user_name"] = user_name
+
     name = flask.request.remote_addr
     if "name" in data:
         name = data["name"]
@@ -224,17 +493,119 @@ def comp_connect():
         return jsonify({"count": 1, "actions": [Errors.gen_action(Errors.USER_NOT_FOUND)]})
     
     computer = comp_handler.get_computer(user_name, flask.request.remote_addr, create_new=True, name=name)
+    if computer is None:
+        return jsonify({"count": 1, "actions": [Errors.gen_action(Errors.TOO_MANY_COMPUTERS)]})
+
+    return computer_answer(computer, data, start_time)
+
+
+def token_request(data: dict, start_time: float):
+    """
+    Answer request of agent with token: computer is found by token, not by session and address
+    """
+
+    computer = comp_handler.get_computer_by_token(data["token"])
+    if computer is None:
+        return jsonify({"count": 1, "actions": [Errors.gen_action(Errors.WRONG_TOKEN)]})
+
+    retry_after = check_limit(user_limiter, computer.user_name)
+    if retry_after:
+        return rate_limited(retry_after)
+
+    return computer_answer(computer, {**data, "user_name": computer.user_name, TOKEN_AUTHORIZED: True}, start_time)
+
+
+def computer_answer(computer: Computer, data: dict, start_time: float):
     computer.checked()
 
     parsed_answer = computer.parse_answer(data)
 
-    if isinstance(parsed_answer, dict):
-        parsed_answer = [parsed_answer]
-
-    print(parsed_answer)
+    if parsed_answer or "action" in data or "actions" in data:
+        main_logger.event("computer.request", user=computer.user_name, computer=computer.id,
+                          latency=perf_counter() - start_time, method=data.get("type"), actions=len(parsed_answer))
 
     return jsonify({"count": len(parsed_answer), "actions": parsed_answer})
 
 
-comp_handler.run()
-app.run(debug=debug, host=app_ip)
+@sock.route("/ws")
+def comp_socket(ws):
+    send = socket_sender(ws)
+    data = json.loads(ws.receive())
+
+    wrong_args = agent_request_errors(data)
+    if wrong_args:
+        return send(Errors.gen_action(Errors.NEED_ARGS, args=wrong_args))
+
+    if "user_name" not in data and "token" not in data:
+        return send(Errors.gen_action(Errors.NEED_ARGS))
+
+    if "token" in data:
+        computer = comp_handler.get_computer_by_token(data["token"])
+        if computer is None:
+            return send(Errors.gen_action(Errors.WRONG_TOKEN))
+
+        user_name = computer.user_name
+        data = dict(data, user_name=user_name)
+    else:
+        user_name = data["user_name"]
+        computer = None
+
+    # Reconnect storms are limited like /a requests
+    retry_after = check_limit(address_limiter, flask.request.remote_addr) or check_limit(user_limiter, user_name)
+    if retry_after:
+        return send(retry_action(retry_after))
+
+    if computer is None:
+        if not database.is_user(user_name):
+            return send(Errors.gen_action(Errors.USER_NOT_FOUND))
+
+        computer = comp_handler.get_computer(user_name, flask.request.remote_addr, create_new=True,
+                                             name=data.get("name", flask.request.remote_addr))
+        if computer is None:
+            return send(Errors.gen_action(Errors.TOO_MANY_COMPUTERS))
+
+    # Token is sent once, but all messages of socket are authorized by it
+    authorized = {TOKEN_AUTHORIZED: True} if "token" in data else {}
+
+    computer.add_listener(send)
+
+    # If the first message has "ack", actions, that weren't acknowledged through previous connection, are sent again
+    redeliver = "ack" in data
+
+    try:
+        while computer.connected:
+            computer.checked()
+
+            parsed_answer = computer.parse_answer({**data, "get_actions": redeliver, **authorized})
+            redeliver = False
+            if parsed_answer:
+                send(parsed_answer)
+
+            computer.push_actions()
+
+            message = ws.receive(timeout=socket_heartbeat)
+            data = json.loads(message) if message else {}
+    finally:
+        computer.remove_listener(send)
+
+
+def create_app():
+    """
+    App factory for WSGI servers, starts background threads in the worker process
+
+    :return: Flask app
+    """
+
+    comp_handler.run()
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dev", action="store_true", help="Run flask development server with debugger and reloader")
+    args = parser.parse_args()
+
+    if args.dev:
+        create_app().run(debug=True, host=app_ip, port=app_port)
+    else:
+        os.execvp("gunicorn", ["gunicorn", "-c", "gunicorn.conf.py", "main:create_app()"])
@@ -0,0 +1,184 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Tuple, Union
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+
+    if extra:
+        labels.append(extra)
+
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+        self.lock = Lock()
+
+    def label_values(self, labels: dict) -> Tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self) -> list:
+        """
+        :return: List of (name suffix, labels str, value)
+        """
+
+        return []
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {value}")
+
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = self.label_values(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self) -> list:
+        with self.lock:
+            return [("_total", format_labels(self.labels, key), value) for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = None):
+        super().__init__(name, documentation, labels)
+
+        self.buckets = buckets if buckets is not None else self.default_buckets
+        # label values -> [counts by bucket (last one is +Inf), sum]
+        self.values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.label_values(labels)
+        bucket = bisect_left(self.buckets, value)
+
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+
+            item = self.values[key]
+            item[0][bucket] += 1
+            item[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start_time, **labels)
+
+    def samples(self) -> list:
+        ret = []
+
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+
+        for key, counts, total in values:
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                ret.append(("_bucket", format_labels(self.labels, key, f'le="{bound}"'), cumulative))
+
+            ret.append(("_sum", format_labels(self.labels, key), total))
+            ret.append(("_count", format_labels(self.labels, key), cumulative))
+
+        return ret
+
+
+class Gauge(Metric):
+    """
+    Value is calculated by function on scrape, so it costs nothing on hot paths
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], Union[float, Dict[Tuple, float]]],
+                 labels: Tuple[str, ...] = ()):
+        """
+        :param function: Returns value or {label values: value} if metric has labels
+        """
+
+        super().__init__(name, documentation, labels)
+
+        self.function = function
+
+    def samples(self) -> list:
+        value = self.function()
+
+        if not self.labels:
+            return [("", "", value)]
+
+        return [("", format_labels(self.labels, key), item) for key, item in value.items()]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            self.metrics[metric.name] = metric
+
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = None) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name: str, documentation: str, function: Callable, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, function, labels))
+
+    def render(self) -> str:
+        """
+        :return: Metrics in prometheus text format
+        """
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = Registry()
+
+request_duration = registry.histogram("pc_controller_request_duration_seconds", "HTTP request duration by route",
+                                      ("route", "method", "status"))
+db_query_duration = registry.histogram("pc_controller_db_query_duration_seconds", "SQLite query duration",
+                                       ("db", "query"))
@@ -0,0 +1,292 @@
+"""
+Micro-benchmarks of protocol and registry hot paths. Works offline: the handler uses MemoryBackend and
+the database is created in a temporary directory.
+Functions, that depend on count of user computers, are measured for every size from --sizes.
+
+Examples:
+    python3 microbench.py
+    python3 microbench.py --sizes 10 1000 10000 --output result.json
+    python3 microbench.py --compare microbench_baseline.json
+    python3 microbench.py --output microbench_baseline.json    # update stored baseline
+    python3 microbench.py --login-iterations 600000 --login-workers 4
+"""
+
+import argparse
+import atexit
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from contextlib import redirect_stdout
+from threading import Thread
+
+
+# computer.py creates database.db in the working directory on import
+work_dir = os.getcwd()
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+temp_dir = tempfile.mkdtemp(prefix="pc_controller_microbench_")
+os.chdir(temp_dir)
+atexit.register(shutil.rmtree, temp_dir, True)
+
+from cache import users_cache
+from computer import ComputerHandler, Methods
+from credentials import CredentialEngine, PBKDF2Hasher
+from database import Database
+from tokens import TokenSigner
+
+
+user_name = "bench"
+
+
+def make_handler(size: int) -> ComputerHandler:
+    """
+    :return: Handler with size computers of one user, computer with id n has address 10.0.x.y of n
+    """
+
+    handler = ComputerHandler()
+
+    for i in range(1, size + 1):
+        computer = handler.connect(user_name, address(i), f"computer{i}")
+        computer.add_button("button", "Button")
+
+    return handler
+
+
+def address(i: int) -> str:
+    return f"10.{i // 65536}.{i // 256 % 256}.{i % 256}"
+
+
+def fleet_benchmarks(size: int) -> dict:
+    """
+    :return: {name: function} of benchmarks for fleet of size computers
+    """
+
+    handler = make_handler(size)
+    last = handler.get_computer(user_name, _id=size)
+    new_adr = address(size + 1)
+
+    def get_computer_create_new():
+        computer = handler.get_computer(user_name, new_adr, create_new=True, name="new")
+        handler.disconnect(user_name, computer.id)
+
+    def connect():
+        computer = handler.connect(user_name, new_adr, "new")
+        handler.disconnect(user_name, computer.id)
+
+    def list_computers_delta():
+        # One computer was changed since the version of client
+        version = handler.versions[user_name]
+        last.notify_update()
+        handler.list_computers(user_name, since=version)
+
+    return {
+        "get_computer_id": lambda: handler.get_computer(user_name, _id=size),
+        "get_computer_adr": lambda: handler.get_computer(user_name, last.adr),
+        "select_computers_name": lambda: handler.select_computers(user_name, name=last.name),
+        "list_computers_online": lambda: handler.list_computers(user_name, online=True, limit=10),
+        "get_computer_create_new": get_computer_create_new,
+        "connect": connect,
+        "list_computers_page": lambda: handler.list_computers(user_name),
+        "list_computers_delta": list_computers_delta,
+        # Not delivered clicks are coalesced, so queues don't grow
+        "click_selected": lambda: handler.press_buttons(
+            user_name, "button", handler.select_computers(user_name, name="computer*", online=True)),
+    }
+
+
+def benchmarks() -> dict:
+    """
+    :return: {name: function} of benchmarks, that don't depend on fleet size
+    """
+
+    handler = make_handler(1)
+    handler.tokens = TokenSigner("bench")
+    computer = handler.get_computer(user_name, _id=1)
+    backend = handler.backend
+    token, _ = handler.tokens.sign(user_name, computer.id, computer.nonce)
+
+    click = {"action": "method", "type": "button.click", "name": "button"}
+    add = {"action": "method", "type": "button.add", "name": "button", "text": "Button"}
+
+    def get_actions_click():
+        backend.click(user_name, computer.id, "button")
+        computer.get_actions()
+
+    database = Database("database.db")
+    with redirect_stdout(io.StringIO()):
+        database.new_user(user_name, "password")
+
+    def is_user_uncached():
+        users_cache.invalidate(user_name)
+        database.is_user(user_name)
+
+    return {
+        "action_parse": lambda: Methods.parse(click),
+        "parse_action_add": lambda: computer.parse_action(add),
+        "parse_action_click": lambda: computer.parse_action(click),
+        "get_actions_empty": computer.get_actions,
+        "get_actions_click": get_actions_click,
+        "get_computer_by_token": lambda: handler.get_computer_by_token(token),
+        "is_user_cached": lambda: database.is_user(user_name),
+        "is_user_uncached": is_user_uncached,
+    }
+
+
+def measure(function, repeat: int) -> float:
+    """
+    :return: The best time of one call in microseconds
+    """
+
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def memory_per_computer(size: int, buttons: int = 3) -> int:
+    """
+    :return: Memory of handler in bytes divided by count of computers, each computer has buttons buttons
+    """
+
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+
+    handler = make_handler(size)
+    for computer in handler.get_user_computers(user_name):
+        computer.add_buttons([{"name": f"button{i}", "text": f"Button {i}"} for i in range(buttons)])
+
+    memory = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    return round(memory / size)
+
+
+def restore_time(size: int, buttons: int = 3) -> float:
+    """
+    :return: Seconds to restore handler with size computers from snapshot
+    """
+
+    handler = ComputerHandler(snapshot_path="snapshot.jsonl.gz")
+
+    for i in range(1, size + 1):
+        computer = handler.connect(f"user{i // 10}", address(i), f"computer{i}")
+        computer.add_buttons([{"name": f"button{j}", "text": f"Button {j}"} for j in range(buttons)])
+
+    handler.save_snapshot()
+
+    handler = ComputerHandler(snapshot_path="snapshot.jsonl.gz")
+    start_time = time.perf_counter()
+    handler.restore_snapshot()
+
+    return round(time.perf_counter() - start_time, 3)
+
+
+def login_rate(iterations: int, workers: int, duration: float = 2) -> float:
+    """
+    :return: Logins per second, when more users log in at once than there are password workers
+    """
+
+    database = Database("logins.db", credentials=CredentialEngine([PBKDF2Hasher(iterations)], workers))
+    with redirect_stdout(io.StringIO()):
+        database.new_user("login_bench", "password")
+
+    logins = []
+    end_time = time.perf_counter() + duration
+
+    def login():
+        while time.perf_counter() < end_time:
+            if database.check_user("login_bench", "password"):
+                logins.append(1)
+
+    start_time = time.perf_counter()
+    threads = [Thread(target=login) for _ in range(workers * 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return round(len(logins) / (time.perf_counter() - start_time), 1)
+
+
+def run(sizes: list, repeat: int) -> dict:
+    """
+    :return: {benchmark name: microseconds per call}, fleet benchmarks are named "<name>[<size>]"
+    """
+
+    results = {name: measure(function, repeat) for name, function in benchmarks().items()}
+
+    for size in sizes:
+        for name, function in fleet_benchmarks(size).items():
+            results[f"{name}[{size}]"] = measure(function, repeat)
+
+    return {name: round(value, 3) for name, value in results.items()}
+
+
+def run_memory(sizes: list) -> dict:
+    """
+    :return: {"bytes_per_computer[<size>]": bytes}
+    """
+
+    return {f"bytes_per_computer[{size}]": memory_per_computer(size) for size in sizes}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    :return: Names of benchmarks, which are slower (or use more memory) than baseline more than threshold times
+    """
+
+    # Rates are better when they are higher
+    return [name for name, value in results.items() if name in baseline and
+            (value * threshold < baseline[name] if name.startswith("logins_per_sec") else
+             value > baseline[name] * threshold)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of hot paths")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100, 1000], help="Computers count of user")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--restore-size", type=int, default=100000, help="Computers count in restored snapshot")
+    parser.add_argument("--login-iterations", type=int, default=600000, help="PBKDF2 iterations of login benchmark")
+    parser.add_argument("--login-workers", type=int, default=2, help="Password workers of login benchmark")
+    parser.add_argument("--output", help="Write results to json file")
+    parser.add_argument("--compare", help="Baseline file to compare with")
+    parser.add_argument("--threshold", type=float, default=1.5, help="Max allowed slowdown against baseline")
+    args = parser.parse_args()
+
+    args.output, args.compare = (os.path.join(work_dir, path) if path else path for path in (args.output, args.compare))
+
+    results = run(args.sizes, args.repeat)
+    memory = run_memory(args.sizes)
+    restore = {f"restore_seconds[{args.restore_size}]": restore_time(args.restore_size)}
+    logins = {f"logins_per_sec[{args.login_iterations}]": login_rate(args.login_iterations, args.login_workers)}
+    output = {"unit": "us", "results": results, "memory": memory, "restore": restore, "logins": logins}
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=4)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+        current = dict(results, **memory, **restore, **logins)
+        baseline = dict(baseline["results"], **baseline.get("memory", {}), **baseline.get("restore", {}),
+                        **baseline.get("logins", {}))
+
+        output["baseline"] = {name: round(current[name] / baseline[name], 2) for name in current if name in baseline}
+        output["regressions"] = compare(current, baseline, args.threshold)
+
+    print(json.dumps(output, indent=4))
+
+    if output.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
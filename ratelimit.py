@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Union
+
+from metrics import registry
+
+
+rate_limited = registry.counter("pc_controller_rate_limited", "Requests rejected by rate limiters", ("limiter",))
+
+
+class RateLimiter:
+    """
+    Thread-safe token buckets by key. Bucket gets rate tokens per second up to burst, each request takes one token
+    """
+
+    def __init__(self, name: str, rate: float, burst: float, max_size: int = 100000):
+        """
+        :param name: Name of limiter for metrics
+        :param rate: Tokens per second
+        :param burst: Max count of tokens in bucket
+        :param max_size: Max count of buckets, least recently used buckets are evicted first
+        """
+
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+
+        # key -> [tokens, time of update]
+        self.buckets = OrderedDict()
+        self.lock = Lock()
+
+    def acquire(self, key, cost: float = 1) -> float:
+        """
+        :return: 0 if request is allowed, otherwise seconds to wait before retry
+        """
+
+        now = monotonic()
+
+        with self.lock:
+            bucket = self.buckets.get(key)
+
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+
+                if len(self.buckets) > self.max_size:
+                    self.buckets.popitem(last=False)
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                self.buckets.move_to_end(key)
+
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0
+
+            retry_after = (cost - bucket[0]) / self.rate
+
+        rate_limited.inc(limiter=self.name)
+
+        return retry_after
+
+
+def create_limiter(name: str, limit) -> Union[RateLimiter, None]:
+    """
+    :param name: Name of limiter for metrics
+    :param limit: [rate, burst] from config, None or empty list disables limiter
+    :return: RateLimiter or None
+    :raise ValueError: If rate isn't positive or burst is less than one request
+    """
+
+    if not limit:
+        return None
+
+    rate, burst = limit
+
+    if rate <= 0 or burst < 1:
+        raise ValueError(f"{name}_rate_limit must be [rate > 0, burst >= 1] or null, got {limit}")
+
+    return RateLimiter(name, rate, burst)
@@ -0,0 +1,89 @@
+import gzip
+import json
+import os
+
+from threading import Lock
+from typing import Dict, List
+
+
+class Snapshot:
+    """
+    Snapshot of computers in gzip file with json lines. Each line is [user name, computers] with the full state of
+    one user, so snapshot is updated incrementally by appending lines of changed users. The last line of user wins.
+    When the file has too many old lines, it is rewritten
+    """
+
+    def __init__(self, path: str = "snapshot.jsonl.gz"):
+        self.path = path
+        self.lock = Lock()
+
+        # Count of lines in file
+        self.lines = 0
+
+    def load(self) -> Dict[str, List[list]]:
+        """
+        :return: {user name: computers}, computer is [id, adr, name, buttons ({name: text}), tags]
+        """
+
+        ret = {}
+        lines = 0
+
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        user_name, computers = json.loads(line)
+                    except ValueError:
+                        # The last line may be not written completely
+                        continue
+
+                    ret[user_name] = computers
+                    lines += 1
+        except (FileNotFoundError, EOFError, gzip.BadGzipFile):
+            pass
+
+        with self.lock:
+            self.lines = lines
+
+        return {user_name: computers for user_name, computers in ret.items() if computers}
+
+    @staticmethod
+    def encode(users: Dict[str, List[list]]) -> bytes:
+        return "".join(json.dumps([user_name, computers], ensure_ascii=False, separators=(",", ":")) + "\n"
+                       for user_name, computers in users.items()).encode()
+
+    def need_rewrite(self, users_count: int) -> bool:
+        """
+        :param users_count: Count of users with computers now
+        :return: True if most lines of file are old
+        """
+
+        return self.lines > 2 * users_count + 1000
+
+    def append(self, users: Dict[str, List[list]]):
+        """
+        :param users: {user name: computers} of changed users, empty list if user has no computers now
+        """
+
+        with self.lock:
+            # Every write is a new gzip member, gzip reads them as one stream
+            with gzip.open(self.path, "ab", compresslevel=1) as file:
+                file.write(self.encode(users))
+
+            self.lines += len(users)
+
+    def write(self, users: Dict[str, List[list]]):
+        """
+        Rewrite snapshot with the full state of all users
+        """
+
+        users = {user_name: computers for user_name, computers in users.items() if computers}
+        temp_path = self.path + ".tmp"
+
+        with self.lock:
+            with gzip.open(temp_path, "wb", compresslevel=1) as file:
+                file.write(self.encode(users))
+
+            os.replace(temp_path, self.path)
+
+            self.lines = len(users)
@@ -0,0 +1,50 @@
+import importlib
+import json
+import os
+import sys
+
+import pytest
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def server_dir(tmp_path_factory):
+    """
+    Server modules open config.json, database.db and logs/ in working directory on import,
+    so they are imported in a temporary one
+    """
+
+    path = tmp_path_factory.mktemp("server")
+    (path / "config.json").write_text(json.dumps({"password_iterations": 1000, "snapshot_path": "",
+                                                  "token_secret": "test"}))
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(path)
+        # main imports computer and the rest of server
+        importlib.import_module("main")
+
+    return path
+
+
+@pytest.fixture(scope="session")
+def computer_module(server_dir):
+    import computer
+    return computer
+
+
+@pytest.fixture(scope="session")
+def main_module(server_dir):
+    import main
+    return main
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """
+    Files of each test (snapshots, state databases) are written to its own directory
+    """
+
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,75 @@
+import pytest
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, server_dir, workdir):
+    from backend import MemoryBackend, SQLiteBackend
+
+    backend = MemoryBackend() if request.param == "memory" else SQLiteBackend(str(workdir / "state.db"))
+    assert backend.add_computer("user", "10.0.0.1", "pc", 0, "nonce") == 1
+
+    return backend
+
+
+def test_delivered_entries_wait_for_ack(backend):
+    backend.click("user", 1, "a")
+
+    assert backend.deliver_actions("user", 1) == [(1, "a", 1)]
+    assert backend.deliver_actions("user", 1) == []
+    # Answer was lost, agent asks again without acknowledging
+    assert backend.deliver_actions("user", 1, redeliver=True) == [(1, "a", 1)]
+
+    assert backend.ack_actions("user", 1, 1) == {"a": 1}
+    assert backend.deliver_actions("user", 1, redeliver=True) == []
+
+
+def test_clicks_coalesce_until_delivered(backend):
+    backend.click("user", 1, "a")
+    backend.click("user", 1, "a")
+    assert backend.deliver_actions("user", 1) == [(1, "a", 2)]
+
+    # Delivered entry keeps its count, so the next click gets a new seq
+    backend.click("user", 1, "a")
+    assert backend.deliver_actions("user", 1) == [(2, "a", 1)]
+
+
+def test_ack_deletes_only_acknowledged_seqs(backend):
+    backend.click("user", 1, "a")
+    backend.click("user", 1, "b")
+    backend.deliver_actions("user", 1)
+
+    assert backend.ack_actions("user", 1, 1) == {"a": 1}
+    assert backend.deliver_actions("user", 1, redeliver=True) == [(2, "b", 1)]
+
+
+def test_take_pending_clicks_keeps_delivered_entries(backend):
+    backend.click("user", 1, "a")
+    backend.click("user", 1, "b")
+    backend.deliver_actions("user", 1)
+
+    backend.click("user", 1, "a", 2)
+    backend.click("user", 1, "b", 3)
+
+    assert backend.take_pending_clicks("user", 1, "a") == {"a": 2}
+    assert backend.deliver_actions("user", 1, redeliver=True) == [(1, "a", 1), (2, "b", 1), (4, "b", 3)]
+    assert backend.take_pending_clicks("user", 1) == {}
+
+
+def test_reset_counter_keeps_clicks_waiting_for_ack(computer_module):
+    handler = computer_module.ComputerHandler()
+    comp = handler.connect("user", "10.0.0.1", "pc")
+    comp.add_buttons([{"name": "a", "text": "A"}, {"name": "b", "text": "B"}])
+
+    # The first ack switches computer to acknowledgements
+    comp.parse_answer({"ack": 0})
+    comp.press_button("a")
+    assert comp.parse_answer({"ack": 0, "get_actions": True})[0]["seq"] == 1
+
+    comp.press_button("a")
+    comp.press_button("b")
+    comp.parse_answer({"action": "method", "type": "button.reset_cur_counter", "name": "a"})
+
+    actions = comp.parse_answer({"ack": 1, "get_actions": True})
+
+    assert [(action["name"], action["seq"]) for action in actions] == [("b", 3)]
+    assert comp.buttons["a"].all_click_count == 2
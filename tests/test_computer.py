@@ -0,0 +1,65 @@
+from threading import Thread
+from time import sleep
+
+import pytest
+
+
+@pytest.fixture
+def timeouts(computer_module, monkeypatch):
+    monkeypatch.setattr(computer_module, "ONLINE_TIMEOUT", 0.3)
+    monkeypatch.setattr(computer_module, "EVICT_TIMEOUT", 30)
+
+
+@pytest.fixture
+def handler(computer_module, timeouts):
+    handler = computer_module.ComputerHandler()
+    Thread(target=handler.checker, daemon=True).start()
+    return handler
+
+
+def test_computer_goes_offline_again_after_coming_back(handler):
+    comp = handler.connect("user", "10.0.0.1", "pc")
+
+    sleep(0.5)
+    assert not comp.online
+
+    comp.checked()
+    assert comp.online
+
+    # Agent died after coming back, the online timeout is checked again, not the eviction
+    sleep(0.5)
+    assert not comp.online
+    assert handler.ids_by_state("user", False) == {comp.id}
+
+
+def test_restored_computer_goes_offline_after_coming_back(computer_module, handler):
+    handler.snapshot = computer_module.Snapshot("snapshot.jsonl.gz")
+    handler.connect("user", "10.0.0.1", "pc")
+    handler.save_snapshot(rewrite=True)
+
+    restored = computer_module.ComputerHandler(snapshot_path="snapshot.jsonl.gz")
+    Thread(target=restored.checker, daemon=True).start()
+    restored.restore_snapshot()
+
+    comp = restored.get_computer("user", "10.0.0.1")
+    assert not comp.online
+
+    comp.checked()
+    assert comp.online
+
+    sleep(0.5)
+    assert not comp.online
+
+
+def test_stale_deadlines_are_skipped(handler):
+    comp = handler.connect("user", "10.0.0.1", "pc")
+
+    for _ in range(3):
+        sleep(0.5)
+        comp.checked()
+
+    # Each come back replaces the deadline, so the computer has one valid entry in heap
+    with handler.deadlines_condition:
+        valid = [entry for entry in handler.deadlines if entry[2] is comp and entry[0] == comp.deadline]
+
+    assert len(valid) == 1
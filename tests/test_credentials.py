@@ -0,0 +1,97 @@
+import hashlib
+
+from threading import Thread, Event
+
+import pytest
+
+
+@pytest.fixture
+def credentials(server_dir):
+    import credentials
+    return credentials
+
+
+@pytest.fixture
+def blocking_hasher(credentials):
+    class BlockingHasher(credentials.Hasher):
+        """
+        Hashes only after release is set, so workers stay busy as long as test needs
+        """
+
+        name = "blocking"
+
+        def __init__(self):
+            self.started = Event()
+            self.release = Event()
+
+        def hash(self, password: str) -> str:
+            self.started.set()
+            self.release.wait(5)
+            return f"{self.name}${password}"
+
+        def verify(self, password: str, stored: str) -> bool:
+            return stored == self.hash(password)
+
+    return BlockingHasher()
+
+
+def test_pbkdf2_hash(credentials):
+    hasher = credentials.PBKDF2Hasher(1000)
+    stored = hasher.hash("password")
+
+    assert stored.startswith("pbkdf2_sha256$1000$")
+    assert hasher.verify("password", stored)
+    assert not hasher.verify("other", stored)
+    assert not hasher.verify("password", "pbkdf2_sha256$broken")
+
+    assert not hasher.needs_update(stored)
+    assert credentials.PBKDF2Hasher(2000).needs_update(stored)
+
+
+def test_old_sha256_hash_is_verified_and_updated(credentials):
+    engine = credentials.CredentialEngine([credentials.PBKDF2Hasher(1000), credentials.Sha256Hasher()])
+    stored = hashlib.sha256(b"password").hexdigest()
+
+    assert engine.verify("password", stored)
+    assert not engine.verify("other", stored)
+    assert engine.needs_update(stored)
+    assert not engine.needs_update(engine.hash("password"))
+
+
+def test_busy_workers_reject_requests(credentials, blocking_hasher):
+    engine = credentials.CredentialEngine([blocking_hasher], workers=1, queue_size=0)
+    results = []
+
+    thread = Thread(target=lambda: results.append(engine.hash("password")))
+    thread.start()
+    assert blocking_hasher.started.wait(5)
+
+    # The only worker is busy and there is no queue, so requests are rejected without waiting
+    assert engine.hash("password") is None
+    assert engine.verify("password", "blocking$password") is None
+
+    blocking_hasher.release.set()
+    thread.join(5)
+
+    assert results == ["blocking$password"]
+    assert engine.verify("password", "blocking$password")
+
+
+def test_login_replaces_old_hash(credentials, workdir):
+    from database import Database
+
+    database = Database(str(workdir / "database.db"), credentials=credentials.CredentialEngine(
+        [credentials.PBKDF2Hasher(1000), credentials.Sha256Hasher()]))
+
+    with database.connection() as db:
+        db.execute("INSERT INTO users VALUES (?, ?, 0, '')", (credentials.login_digest("old_user"),
+                                                               hashlib.sha256(b"password").hexdigest()))
+
+    assert database.check_user("old_user", "password")
+
+    with database.connection() as db:
+        stored = db.execute("SELECT password FROM users").fetchone()[0]
+
+    assert stored.startswith("pbkdf2_sha256$1000$")
+    assert database.check_user("old_user", "password")
+    assert not database.check_user("old_user", "other")
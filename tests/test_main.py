@@ -0,0 +1,122 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def user(main_module, request):
+    user_name = "user_" + request.node.name
+    main_module.database.new_user(user_name, "password")
+    return user_name
+
+
+@pytest.fixture
+def client(main_module, user):
+    client = main_module.app.test_client()
+
+    with client.session_transaction() as session:
+        session["login"] = user
+
+    return client
+
+
+def test_computers_etag_gives_304_or_full_page(main_module, user, client):
+    first = main_module.comp_handler.connect(user, "10.0.0.1", "first")
+
+    response = client.get("/api/computers")
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+
+    assert client.get("/api/computers", headers={"If-None-Match": etag}).status_code == 304
+
+    second = main_module.comp_handler.connect(user, "10.0.0.2", "second")
+    response = client.get("/api/computers", headers={"If-None-Match": etag})
+
+    # Cached full page is replaced, so it must not be a delta
+    assert response.status_code == 200
+    assert response.json["full"]
+    assert [comp["id"] for comp in response.json["computers"]] == [first.id, second.id]
+
+
+def test_computers_delta_since_version(main_module, user, client):
+    main_module.comp_handler.connect(user, "10.0.0.1", "first")
+    version = client.get("/api/computers").json["version"]
+
+    assert client.get("/api/computers", query_string={"since": version}).status_code == 304
+
+    second = main_module.comp_handler.connect(user, "10.0.0.2", "second")
+    answer = client.get("/api/computers", query_string={"since": version}).json
+
+    assert not answer["full"]
+    assert [comp["id"] for comp in answer["computers"]] == [second.id]
+
+    main_module.comp_handler.disconnect(user, second.id)
+    answer = client.get("/api/computers", query_string={"since": answer["version"]}).json
+
+    assert answer["computers"] == [] and answer["removed"] == [second.id]
+
+
+def test_computers_unknown_version_gives_full_page(main_module, user, client):
+    main_module.comp_handler.connect(user, "10.0.0.1", "first")
+
+    answer = client.get("/api/computers", query_string={"since": "other-process-7"}).json
+
+    assert answer["full"]
+    assert len(answer["computers"]) == 1
+
+
+@pytest.mark.parametrize("body, wrong_args", [
+    ({"name": "b", "ids": "1"}, ["ids"]),
+    ({"name": "b", "ids": [1, True]}, ["ids"]),
+    ({"name": ["b"], "ids": [1]}, ["name"]),
+    ({"name": "b", "select": {}}, ["select"]),
+    ({"name": "b", "select": {"color": "red", "name": ["pc"], "status": "on"}},
+     ["select.color", "select.name", "select.status"]),
+    ([1], ["name", "ids"]),
+])
+def test_bulk_click_rejects_wrong_args(client, body, wrong_args):
+    response = client.post("/api/computers/click", json=body)
+
+    assert response.status_code == 400
+    assert response.json["actions"] == [{"action": "error", "type": "need_args", "args": wrong_args}]
+
+
+def test_bulk_click_by_ids_and_selector(main_module, user, client):
+    first = main_module.comp_handler.connect(user, "10.0.0.1", "lab-1")
+    second = main_module.comp_handler.connect(user, "10.0.1.1", "office")
+    first.add_button("b", "B")
+    second.add_button("b", "B")
+
+    answer = client.post("/api/computers/click", json={"name": "b", "ids": [first.id, 99]}).json
+    assert [(action["type"], action["id"]) for action in answer["actions"]] == \
+           [("ok", first.id), ("computer_not_found", 99)]
+
+    answer = client.post("/api/computers/click", json={"name": "b", "select": {"name": "lab-*"}}).json
+    assert [action["id"] for action in answer["actions"]] == [first.id]
+
+    assert [action["count"] for action in first.get_actions()] == [2]
+    assert [action["count"] for action in second.get_actions()] == []
+
+
+@pytest.mark.parametrize("data, wrong_args", [
+    ({"action": "method", "type": ["button.click"]}, ["type"]),
+    ({"action": "method", "type": "button.click", "name": {"a": 1}}, ["name"]),
+    ({"action": "method", "type": "button.reset_cur_counter", "name": [1]}, ["name"]),
+    ({"action": "method", "type": "button.add_many", "buttons": [{"name": 1, "text": "B"}]}, ["name", "text"]),
+])
+def test_agent_action_with_wrong_types(computer_module, data, wrong_args):
+    comp = computer_module.ComputerHandler().connect("user", "10.0.0.1", "pc")
+
+    assert comp.parse_answer(data) == [{"action": "error", "type": "need_args", "args": wrong_args}]
+
+
+@pytest.mark.parametrize("data, wrong_args", [
+    ({"user_name": ["user"]}, ["user_name"]),
+    ({"user_name": "user", "name": {"a": 1}}, ["name"]),
+    ([1, 2], ["user_name"]),
+])
+def test_agent_request_with_wrong_types(client, data, wrong_args):
+    # /a expects json string with json object inside
+    answer = client.post("/a", json=json.dumps(data)).json
+
+    assert answer["actions"] == [{"action": "error", "type": "need_args", "args": wrong_args}]
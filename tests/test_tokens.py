@@ -0,0 +1,81 @@
+import pytest
+
+
+@pytest.fixture
+def signer(server_dir):
+    from tokens import TokenSigner
+    return TokenSigner("secret")
+
+
+@pytest.fixture
+def handler(computer_module, signer):
+    return computer_module.ComputerHandler(tokens=signer)
+
+
+def test_token_verify(server_dir, signer):
+    from tokens import TokenSigner
+
+    token, expires = signer.sign("пользователь", 3, "nonce")
+
+    assert signer.verify(token) == ("пользователь", 3, "nonce")
+    assert signer.verify(token[:-2] + "xx") is None
+    assert TokenSigner("other").verify(token) is None
+    assert signer.verify(None) is None
+    assert signer.verify("ключ.подпись") is None
+
+
+def test_expired_token(server_dir):
+    from tokens import TokenSigner
+
+    signer = TokenSigner("secret", ttl=-1)
+    token, _ = signer.sign("user", 1, "nonce")
+
+    assert signer.verify(token) is None
+
+
+def test_token_of_reused_id_is_rejected(handler, signer):
+    comp = handler.connect("user", "10.0.0.1", "pc")
+    token, _ = signer.sign("user", comp.id, comp.nonce)
+    assert handler.get_computer_by_token(token) is comp
+
+    # New computer from the same address gets the same id and name
+    handler.disconnect("user", comp.id)
+    new_comp = handler.connect("user", "10.0.0.1", "pc")
+
+    assert new_comp.id == comp.id
+    assert handler.get_computer_by_token(token) is None
+
+
+def test_broadcast_computer_has_no_token(handler, signer):
+    handler.connect("user", "10.0.0.1", "pc")
+    token, _ = signer.sign("user", 0, "nonce")
+
+    assert handler.get_computer_by_token(token) is None
+
+
+def test_get_token_checks_hash_key_of_owner(main_module, handler):
+    database = main_module.database
+    database.new_user("token_owner", "password")
+    database.new_user("token_other", "password")
+    database.create_hash_key("token_owner")
+    database.create_hash_key("token_other")
+
+    comp = handler.connect("token_owner", "10.0.0.1", "pc")
+    request = {"action": "method", "type": "computer.get_token"}
+
+    assert len(database.get_hash_key("token_owner")) == 64
+    assert comp.parse_answer(request)[0]["type"] == "need_hash_key"
+    assert comp.parse_answer({**request, "user_name": "token_other",
+                              "hash_key": database.get_hash_key("token_other")})[0]["type"] == "wrong_hash_key"
+
+    answer = comp.parse_answer({**request, "hash_key": database.get_hash_key("token_owner")})[0]
+    assert handler.get_computer_by_token(answer["token"]) is comp
+
+
+def test_batch_rejects_credentials_of_action(handler):
+    comp = handler.connect("user", "10.0.0.1", "pc")
+
+    answer = comp.parse_answer({"user_name": "user", "actions": [
+        {"action": "method", "type": "computer.get_token", "user_name": "other", "hash_key": "key"}]})
+
+    assert answer == [{"action": "error", "type": "shared_args", "args": ["user_name", "hash_key"]}]
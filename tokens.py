@@ -0,0 +1,76 @@
+import hashlib
+import hmac
+import json
+import secrets
+
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from time import time
+from typing import Union, Tuple
+
+
+def encode(data: bytes) -> str:
+    return urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def decode(data: str) -> bytes:
+    return urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def new_nonce() -> str:
+    """
+    :return: Random nonce of computer, tokens of other computers with the same id don't match it
+    """
+
+    return secrets.token_hex(8)
+
+
+class TokenSigner:
+    """
+    Stateless agent tokens "<payload>.<signature>", payload is [user name, computer id, computer nonce, expiry time].
+    Token is verified by signature only, so polls with token don't need session or database
+    """
+
+    def __init__(self, secret: Union[str, bytes], ttl: float = 86400, signature_size: int = 16):
+        """
+        :param secret: Key of signatures, must be the same in all processes
+        :param ttl: Lifetime of token in seconds
+        :param signature_size: Size of truncated HMAC-SHA256 in bytes
+        """
+
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.ttl = ttl
+        self.signature_size = signature_size
+
+    def signature(self, payload: str) -> str:
+        return encode(hmac.new(self.secret, payload.encode(), hashlib.sha256).digest()[:self.signature_size])
+
+    def sign(self, user_name: str, _id: int, nonce: str) -> Tuple[str, int]:
+        """
+        :return: Token and its expiry time
+        """
+
+        expires = int(time() + self.ttl)
+        payload = encode(json.dumps([user_name, _id, nonce, expires], ensure_ascii=False,
+                                    separators=(",", ":")).encode())
+
+        return f"{payload}.{self.signature(payload)}", expires
+
+    def verify(self, token) -> Union[Tuple[str, int, str], None]:
+        """
+        :return: (user name, computer id, computer nonce) or None, if token is not valid or expired
+        """
+
+        if not isinstance(token, str):
+            return None
+
+        payload, _, signature = token.partition(".")
+
+        if not hmac.compare_digest(self.signature(payload).encode(), signature.encode()):
+            return None
+
+        user_name, _id, nonce, expires = json.loads(decode(payload))
+
+        if expires < time():
+            return None
+
+        return user_name, _id, nonce